@@ -0,0 +1,61 @@
+import numpy as np
+import os
+import time
+import argparse
+import tempfile
+from astropy.io import fits
+
+from fitswriter import formats, write_fits, read_fits
+
+# Write and read throughput of the output formats of enhance.py, compared
+# with the original writer (an uncompressed PrimaryHDU without header)
+
+def legacy_write(output, data):
+    hdu = fits.PrimaryHDU(data)
+    hdu.writeto(output, overwrite=True)
+
+def benchmark(data, header, quantize, repeat, directory):
+    nbytes = data.astype('float32').nbytes / 1024.**2
+    print('Image of {0}x{1} pixels ({2:.1f} MB as float32)'.format(data.shape[0], data.shape[1], nbytes))
+    print('{0:>10s} {1:>10s} {2:>8s} {3:>12s} {4:>12s} {5:>12s}'.format('format', 'size [MB]', 'ratio', 'write [MB/s]', 'read [MB/s]', 'max error'))
+
+    for format in ['legacy'] + formats:
+        filename = os.path.join(directory, '{0}.fits'.format(format))
+
+        write_time = 0.0
+        for i in range(repeat):
+            if os.path.exists(filename):
+                os.remove(filename)
+            start = time.time()
+            if (format == 'legacy'):
+                legacy_write(filename, data)
+            else:
+                write_fits(filename, data, header=header, format=format, quantize=quantize)
+            write_time += (time.time() - start) / repeat
+
+        start = time.time()
+        for i in range(repeat):
+            image, _ = read_fits(filename)
+        read_time = (time.time() - start) / repeat
+
+        size = os.path.getsize(filename) / 1024.**2
+        error = np.max(np.abs(image - data))
+        print('{0:>10s} {1:10.2f} {2:8.2f} {3:12.1f} {4:12.1f} {5:12.3e}'.format(format, size, nbytes / size,
+            nbytes / write_time, nbytes / read_time, error))
+
+if (__name__ == '__main__'):
+
+    parser = argparse.ArgumentParser(description='Benchmark of the output formats')
+    parser.add_argument('-i','--input', help='Enhanced image used for the benchmark', default='output/hmi_enhanced.fits')
+    parser.add_argument('-q','--quantize', help='Quantization level of the compressed formats', type=float, default=16)
+    parser.add_argument('-r','--repeat', help='Number of repetitions', type=int, default=5)
+    parsed = vars(parser.parse_args())
+
+    data, header = read_fits(parsed['input'])
+    data = data.astype('float32')
+    header = header.copy(strip=True)
+
+    with tempfile.TemporaryDirectory() as directory:
+        benchmark(data, header, parsed['quantize'], parsed['repeat'], directory)
+
+    # python benchmark_output.py -i output/hmi_enhanced.fits -q 16
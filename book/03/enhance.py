@@ -3,6 +3,8 @@ import platform
 import os
 import time
 import argparse
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 from astropy.io import fits
 
 # To deactivate warnings: https://github.com/tensorflow/tensorflow/issues/7778
@@ -20,16 +22,53 @@ import tensorflow as tf
 import keras.backend.tensorflow_backend as ktf
 
 import models as nn_model
+from quietsun import normalization_factor
+from fitswriter import formats, enhanced_header, write_fits
 
-class enhance(object):
+# Both keepsize and encdec return images twice as large as the input
+upsampling = 2
 
-    def __init__(self, inputFile, depth, model, activation, ntype, output):
+def configure_session(intra_threads=0, inter_threads=0):
+    """
+    Create the TF session and register it with keras, so that every network
+    built afterwards in this process shares it. The sizes of the TF thread
+    pools can be fixed to avoid oversubscribing nodes shared by several jobs
+    (0 leaves the choice to TF)
+    """
 
 # Only allocate needed memory
-        config = tf.ConfigProto()
-        config.gpu_options.allow_growth=True
-        session = tf.Session(config=config)
-        ktf.set_session(session)
+    config = tf.ConfigProto()
+    config.gpu_options.allow_growth=True
+    config.intra_op_parallelism_threads = intra_threads
+    config.inter_op_parallelism_threads = inter_threads
+    session = tf.Session(config=config)
+    ktf.set_session(session)
+    return session
+
+def augment(image):
+    """
+    The 8 views of a square image under flips and 90 degree rotations
+    """
+    return [np.rot90(image, k) for k in range(4)] + [np.rot90(image[:,::-1], k) for k in range(4)]
+
+def deaugment(views, out):
+    """
+    Undo the transformations of `augment` and average the 8 views into `out`
+    """
+    out[:] = 0.0
+    for k in range(4):
+        out += np.rot90(views[k], -k)
+        out += np.rot90(views[4+k], -k)[:,::-1]
+    out /= 8.0
+    return out
+
+class enhance(object):
+
+    def __init__(self, inputFile, depth, model, activation, ntype, output, session=None, output_format='float32', quantize=16):
+
+        if (session is None):
+            session = configure_session()
+        self.session = session
 
         self.input = inputFile
         self.depth = depth
@@ -37,17 +76,29 @@ class enhance(object):
         self.activation = activation
         self.ntype = ntype
         self.output = output
+        self.output_format = output_format
+        self.quantize = quantize
+        self.header = None
+        self.scale = 1.0
 
 
-    def define_network(self, image):
+    def define_network(self, image, tta=False):
         print("Setting up network...")
 
         self.image = image
         self.nx = image.shape[1]
         self.ny = image.shape[0]
+        self.tta = tta
+
+        # With test-time augmentation all views go in a single batch, so the
+        # network is built for a square frame that also fits the rotated views
+        if (self.tta):
+            model_ny = model_nx = max(self.ny, self.nx)
+        else:
+            model_ny, model_nx = self.ny, self.nx
 
         if (self.network_type == 'encdec'):
-            self.model = nn_model.encdec(self.ny, self.nx, 0.0, self.depth, n_filters=64)
+            self.model = nn_model.encdec(model_ny, model_nx, 0.0, self.depth, n_filters=64)
 
         # if (self.network_type == 'encdec_reflect'):
         #     self.model = nn_model.encdec_reflect(self.nx, self.ny, 0.0, self.depth, n_filters=64)
@@ -56,55 +107,286 @@ class enhance(object):
         #     self.model = nn_model.keepsize_zero(self.nx, self.ny, 0.0, self.depth)
 
         if (self.network_type == 'keepsize'):
-            self.model = nn_model.keepsize(self.ny, self.nx, 0.0, self.depth,n_filters=64, l2_reg=1e-7)
+            self.model = nn_model.keepsize(model_ny, model_nx, 0.0, self.depth,n_filters=64, l2_reg=1e-7)
         
         print("Loading weights...")
         self.model.load_weights("network/{0}_weights.hdf5".format(self.ntype))
 
     
-    def predict(self):
+    def normalize(self, data, header=None):
+        """
+        Estimate the factor that brings the input to the units of the network
+        (I/Ic or kG). It is applied to each frame while filling the input
+        batch, so no normalized copy of the data is ever written
+        """
+        self.scale = normalization_factor(data, self.ntype, header)
+        print('Normalization factor : {0}'.format(self.scale))
+
+    def infer(self):
+        if (self.tta):
+            return self.infer_tta()
+
         print("Predicting validation data...")
 
         input_validation = np.zeros((1,self.ny,self.nx,1), dtype='float32')
         input_validation[0,:,:,0] = self.image
+        input_validation *= self.scale
         
         start = time.time()
         out = self.model.predict(input_validation)
         end = time.time()
         print("Prediction took {0:3.2} seconds...".format(end-start))        
-        
+
+        return out[0,:,:,0]
+
+    def infer_tta(self):
+        print("Predicting validation data with test-time augmentation...")
+
+        # Non-square frames are reflected up to a square one and cropped afterwards
+        nside = max(self.ny, self.nx)
+        image = np.pad(self.image, ((0,nside-self.ny),(0,nside-self.nx)), mode='reflect')
+
+        input_validation = np.zeros((8,nside,nside,1), dtype='float32')
+        for i, view in enumerate(augment(image)):
+            input_validation[i,:,:,0] = view
+        input_validation *= self.scale
+
+        start = time.time()
+        out = self.model.predict(input_validation, batch_size=8)
+        end = time.time()
+        print("Prediction took {0:3.2} seconds...".format(end-start))
+
+        factor = out.shape[1] // nside
+        mean = deaugment(out[:,:,:,0], np.zeros(out.shape[1:3], dtype='float32'))
+
+        return mean[0:factor*self.ny,0:factor*self.nx]
+
+    def save(self, out):
         print("Saving data...")
-        hdu = fits.PrimaryHDU(out[0,:,:,0])
-        import os.path
-        if os.path.exists(self.output):
-            os.system('rm {0}'.format(self.output))
-            print('Overwriting...')
-        hdu.writeto('{0}'.format(self.output))
+        header = enhanced_header(self.header, factor=out.shape[0] // self.ny)
+        if (self.scale != 1.0):
+            header['ENHSCALE'] = (self.scale, 'Normalization applied to the input')
+        write_fits(self.output, out, header=header, format=self.output_format, quantize=self.quantize)
 
         # import matplotlib.pyplot as plt
         # plt.imshow(out[0,:,:,0])
         # plt.savefig('hmi.pdf')
-   
+
+    def predict(self):
+        self.save(self.infer())
+
+
+class enhance_pair(object):
+    """
+    Enhance several products of the same region and time (typically the continuum
+    image and the magnetogram) in a single pass: one TF session, one read of the
+    paired inputs and the networks run back to back on the same field of view
+    while the previous output is written to disk
+    """
+
+    def __init__(self, inputFiles, depth, model, activation, ntypes, outputs, session=None, output_format='float32', quantize=16):
+
+        if (len(inputFiles) != len(ntypes) or len(outputs) != len(ntypes)):
+            raise ValueError('One input and one output are needed per network type')
+
+        if (session is None):
+            session = configure_session()
+
+        self.networks = [enhance(inputFile, depth=depth, model=model, activation=activation, ntype=ntype, output=output, session=session,
+            output_format=output_format, quantize=quantize) for inputFile, ntype, output in zip(inputFiles, ntypes, outputs)]
+
+
+    def read(self):
+        """
+        Read all the paired inputs, which have to share the same field of view
+        """
+        images = []
+        for network in self.networks:
+            f = fits.open(network.input)
+            images.append(f[0].data)
+            network.header = f[0].header
+
+        shapes = set([image.shape for image in images])
+        if (len(shapes) != 1):
+            raise ValueError('Paired inputs have different shapes: {0}'.format(sorted(shapes)))
+
+        return images
+
+
+    def normalize(self, images):
+        for network, image in zip(self.networks, images):
+            network.normalize(image, network.header)
+
+
+    def define_network(self, images, tta=False):
+        for network, image in zip(self.networks, images):
+            print('Model : {0}'.format(network.ntype))
+            network.define_network(image=image, tta=tta)
+
+
+    def predict(self):
+        # Writing the FITS file of one product overlaps with the prediction of the next one
+        with ThreadPoolExecutor(max_workers=1) as writer:
+            pending = []
+            for network in self.networks:
+                pending.append(writer.submit(network.save, network.infer()))
+            for job in pending:
+                job.result()
+
+
+def create_output_cube(output, shape, header=None):
+    """
+    Create an empty float32 FITS cube without holding it in memory and return
+    the offset of its data section, so that several processes can fill it
+    through a memmap
+    """
+    hdu = fits.PrimaryHDU(data=np.zeros((1,1,1), dtype='float32'), header=header)
+    header = hdu.header
+    header['NAXIS1'] = shape[2]
+    header['NAXIS2'] = shape[1]
+    header['NAXIS3'] = shape[0]
+
+    if os.path.exists(output):
+        os.remove(output)
+        print('Overwriting...')
+    header.tofile(output)
+
+    offset = len(header.tostring())
+    size = int(np.prod(shape)) * 4
+    with open(output, 'rb+') as fobj:
+        fobj.seek(offset + ((size + 2879) // 2880) * 2880 - 1)
+        fobj.write(b'\0')
+
+    return offset
+
+
+def enhance_shard(inputFile, output, offset, shape, frames, cores, depth, model, activation, ntype, tta=False, intra_threads=0, inter_threads=0, scale=1.0):
+    """
+    Enhance the frames `frames` of the cube in `inputFile` and write them in
+    the cube created by `create_output_cube`. When `cores` is given the
+    process is pinned to them and, unless fixed, TF uses one thread per core
+    """
+    if (cores is not None):
+        os.sched_setaffinity(0, cores)
+        if (intra_threads == 0):
+            intra_threads = len(cores)
+        if (inter_threads == 0):
+            inter_threads = 1
+
+    session = configure_session(intra_threads, inter_threads)
+
+    f = fits.open(inputFile, memmap=True)
+    cube = f[0].data
+
+    network = enhance(inputFile, depth=depth, model=model, activation=activation, ntype=ntype, output=output, session=session)
+    network.define_network(image=cube[frames[0]], tta=tta)
+    network.scale = scale
+
+    out = np.memmap(output, dtype='>f4', mode='r+', offset=offset, shape=shape)
+    for frame in frames:
+        print('Frame {0}/{1}'.format(frame+1, shape[0]))
+        network.image = cube[frame]
+        out[frame] = network.infer()
+    out.flush()
+
+    del out
+    f.close()
+    ktf.clear_session()
+
+
+def enhance_cube(inputFile, output, depth, model, activation, ntype, tta=False, workers=1, intra_threads=0, inter_threads=0, normalize=False):
+    """
+    Enhance all the frames of a (nt, ny, nx) cube. With several workers each
+    process is pinned to a disjoint subset of the available cores and takes a
+    contiguous range of frames, writing directly to the shared output file.
+    With `normalize` a single normalization factor is estimated for the whole
+    cube, reading it in chunks
+    """
+    f = fits.open(inputFile, memmap=True)
+    nt, ny, nx = f[0].data.shape
+    scale = 1.0
+    if (normalize):
+        scale = normalization_factor(f[0].data, ntype, f[0].header)
+        print('Normalization factor : {0}'.format(scale))
+    header = enhanced_header(f[0].header, factor=upsampling)
+    if (scale != 1.0):
+        header['ENHSCALE'] = (scale, 'Normalization applied to the input')
+    f.close()
+
+    shape = (nt, upsampling*ny, upsampling*nx)
+    offset = create_output_cube(output, shape, header)
+
+    workers = min(workers, nt)
+    frames = [[int(frame) for frame in chunk] for chunk in np.array_split(np.arange(nt), workers)]
+
+    if (workers == 1):
+        enhance_shard(inputFile, output, offset, shape, frames[0], None, depth, model, activation, ntype, tta, intra_threads, inter_threads, scale)
+        return
+
+    cores = sorted(os.sched_getaffinity(0))
+    cores = [[int(core) for core in chunk] for chunk in np.array_split(cores, workers)]
+    cores = [chunk if len(chunk) > 0 else None for chunk in cores]
+
+    print('Sharding {0} frames over {1} workers...'.format(nt, workers))
+    jobs = [(inputFile, output, offset, shape, frames[i], cores[i], depth, model, activation, ntype, tta, intra_threads, inter_threads, scale) for i in range(workers)]
+
+    # TF sessions do not survive a fork, so workers start from a fresh interpreter
+    with multiprocessing.get_context('spawn').Pool(workers) as pool:
+        pool.starmap(enhance_shard, jobs)
+
             
 if (__name__ == '__main__'):
 
     parser = argparse.ArgumentParser(description='Prediction')
-    parser.add_argument('-i','--input', help='input')
-    parser.add_argument('-o','--out', help='out')
+    parser.add_argument('-i','--input', help='input (one per type)', nargs='+')
+    parser.add_argument('-o','--out', help='out (one per type)', nargs='+')
     parser.add_argument('-d','--depth', help='depth', default=5)
     parser.add_argument('-m','--model', help='model', choices=['encdec', 'encdec_reflect', 'keepsize_zero', 'keepsize'], default='keepsize')
     parser.add_argument('-c','--activation', help='Activation', choices=['relu', 'elu'], default='relu')
     # parser.add_argument('-a','--action', help='action', choices=['cube', 'movie'], default='cube')
-    parser.add_argument('-t','--type', help='type', choices=['intensity', 'blos'], default='intensity')
+    parser.add_argument('-t','--type', help='type', choices=['intensity', 'blos'], nargs='+', default=['intensity'])
+    parser.add_argument('--tta', help='Average the prediction over flips and 90 degree rotations', action='store_true')
+    parser.add_argument('-w','--workers', help='Number of processes sharing the frames of a cube', type=int, default=1)
+    parser.add_argument('--intra-threads', help='Threads used by TF inside each operation (0: TF default)', type=int, default=0)
+    parser.add_argument('--inter-threads', help='Threads used by TF to run independent operations (0: TF default)', type=int, default=0)
+    parser.add_argument('-n','--normalize', help='Normalize the input to the quiet Sun (intensity) or to kG (blos)', action='store_true')
+    parser.add_argument('-f','--format', help='Output format (cubes are always written as float32)', choices=formats, default='float32')
+    parser.add_argument('-q','--quantize', help='Quantization level of the compressed formats', type=float, default=16)
     parsed = vars(parser.parse_args())
 
-    f = fits.open(parsed['input'])
-    imgs = f[0].data
+    if (parsed['input'] is None or parsed['out'] is None):
+        parser.error('-i/--input and -o/--out are required')
+    if (len(parsed['input']) != len(parsed['type']) or len(parsed['out']) != len(parsed['type'])):
+        parser.error('One input and one output are needed per type: got {0} inputs, {1} outputs and {2} types'.format(
+            len(parsed['input']), len(parsed['out']), len(parsed['type'])))
 
-    print('Model : {0}'.format(parsed['type']))
-    out = enhance('{0}'.format(parsed['input']), depth=int(parsed['depth']), model=parsed['model'], activation=parsed['activation'],ntype=parsed['type'], output=parsed['out'])
-    out.define_network(image=imgs)
-    out.predict()
+    if (len(parsed['type']) == 1):
+        f = fits.open(parsed['input'][0], memmap=True)
+        imgs = f[0].data
+
+        print('Model : {0}'.format(parsed['type'][0]))
+        if (imgs.ndim == 3):
+            f.close()
+            enhance_cube('{0}'.format(parsed['input'][0]), output=parsed['out'][0], depth=int(parsed['depth']), model=parsed['model'], activation=parsed['activation'], ntype=parsed['type'][0],
+                tta=parsed['tta'], workers=parsed['workers'], intra_threads=parsed['intra_threads'], inter_threads=parsed['inter_threads'], normalize=parsed['normalize'])
+        else:
+            session = configure_session(parsed['intra_threads'], parsed['inter_threads'])
+            out = enhance('{0}'.format(parsed['input'][0]), depth=int(parsed['depth']), model=parsed['model'], activation=parsed['activation'],ntype=parsed['type'][0], output=parsed['out'][0], session=session,
+                output_format=parsed['format'], quantize=parsed['quantize'])
+            out.header = f[0].header
+            if (parsed['normalize']):
+                out.normalize(imgs, f[0].header)
+            out.define_network(image=imgs, tta=parsed['tta'])
+            out.predict()
+    else:
+        session = configure_session(parsed['intra_threads'], parsed['inter_threads'])
+        out = enhance_pair(parsed['input'], depth=int(parsed['depth']), model=parsed['model'], activation=parsed['activation'], ntypes=parsed['type'], outputs=parsed['out'], session=session,
+            output_format=parsed['format'], quantize=parsed['quantize'])
+        imgs = out.read()
+        if (parsed['normalize']):
+            out.normalize(imgs)
+        out.define_network(images=imgs, tta=parsed['tta'])
+        out.predict()
     # To avoid the TF_DeleteStatus message:
     # https://github.com/tensorflow/tensorflow/issues/3388
     ktf.clear_session()
@@ -112,3 +394,9 @@ if (__name__ == '__main__'):
     # python enhance.py -i samples/hmi.fits -t intensity -o output/hmi_enhanced.fits
 
     # python enhance.py -i samples/blos.fits -t blos -o output/blos_enhanced.fits
+
+    # python enhance.py -i samples/hmi.fits samples/blos.fits -t intensity blos -o output/hmi_enhanced.fits output/blos_enhanced.fits
+
+    # python enhance.py -i cube.fits -t intensity -o output/cube_enhanced.fits -w 4
+
+    # python enhance.py -i samples/hmi.fits -t intensity -o output/hmi_enhanced.fits -f rice -q 16
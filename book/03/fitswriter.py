@@ -0,0 +1,79 @@
+import os
+import numpy as np
+from astropy.io import fits
+
+# Output formats of the enhanced images: uncompressed float32 or
+# tile-compressed (lossy, quantized) float32
+formats = ['float32', 'rice', 'hcompress']
+
+compression = {'rice': 'RICE_1', 'hcompress': 'HCOMPRESS_1'}
+
+# Structural keywords of the input that do not describe the enhanced image
+structural = ['SIMPLE', 'XTENSION', 'BITPIX', 'NAXIS', 'NAXIS1', 'NAXIS2', 'NAXIS3', 'EXTEND',
+    'PCOUNT', 'GCOUNT', 'BSCALE', 'BZERO', 'BLANK', 'CHECKSUM', 'DATASUM']
+
+def enhanced_header(header, factor=2):
+    """
+    Copy of the header of the input describing the enhanced image: the pixel
+    scale of the celestial WCS is divided by `factor` and the reference pixel
+    is moved to the same point of the finer grid.
+
+    header - Header of the input image (or None)
+    factor - Upsampling factor of the network
+    """
+    if (header is None):
+        header = fits.Header()
+    else:
+        header = header.copy(strip=True)
+    for key in structural:
+        header.remove(key, ignore_missing=True, remove_all=True)
+
+    for i in [1, 2]:
+        if ('CDELT{0}'.format(i) in header):
+            header['CDELT{0}'.format(i)] /= factor
+        if ('CRPIX{0}'.format(i) in header):
+            header['CRPIX{0}'.format(i)] = factor*(header['CRPIX{0}'.format(i)] - 0.5) + 0.5
+        for j in [1, 2]:
+            if ('CD{0}_{1}'.format(i, j) in header):
+                header['CD{0}_{1}'.format(i, j)] /= factor
+
+    header['HISTORY'] = 'Enhanced x{0} with enhance.py'.format(factor)
+    return header
+
+def write_fits(output, data, header=None, format='float32', quantize=16):
+    """
+    Write an enhanced image. Compressed images go to the first extension as a
+    CompImageHDU, uncompressed ones to the primary HDU.
+
+    output - Name of the file (overwritten if it exists)
+    data - Image
+    header - Header of the image (see enhanced_header)
+    format - One of `formats`
+    quantize - Quantization level of the compressed floats (see the
+               quantize_level of astropy's CompImageHDU). Larger values keep
+               more precision at the expense of a lower compression ratio
+    """
+    data = np.asarray(data, dtype='float32')
+
+    if (format == 'float32'):
+        hdulist = fits.HDUList([fits.PrimaryHDU(data, header=header)])
+    elif (format in compression):
+        hdulist = fits.HDUList([fits.PrimaryHDU(),
+            fits.CompImageHDU(data, header=header, compression_type=compression[format], quantize_level=quantize)])
+    else:
+        raise ValueError('Unknown output format {0}'.format(format))
+
+    if os.path.exists(output):
+        print('Overwriting...')
+    hdulist.writeto(output, overwrite=True)
+
+def read_fits(filename):
+    """
+    Image of the first HDU with data, so that compressed and uncompressed
+    enhanced images are read in the same way.
+    """
+    with fits.open(filename) as f:
+        for hdu in f:
+            if (hdu.data is not None):
+                return np.array(hdu.data), hdu.header
+    raise ValueError('No image found in {0}'.format(filename))
@@ -0,0 +1,144 @@
+import numpy as np
+
+def chunked_range(data, chunk=2**22):
+    """
+    Minimum and maximum of the finite values of an array, read in chunks so
+    that memmapped inputs are never loaded at once.
+
+    data - Array (or memmap) of any shape
+    chunk - Number of elements read at a time
+    """
+    flat = data.reshape(-1)
+    vmin, vmax = np.inf, -np.inf
+    for start in range(0, flat.size, chunk):
+        block = np.asarray(flat[start:start+chunk], dtype='float64')
+        block = block[np.isfinite(block)]
+        if (block.size > 0):
+            vmin = min(vmin, block.min())
+            vmax = max(vmax, block.max())
+    return vmin, vmax
+
+def chunked_histogram(data, bins=2048, vrange=None, chunk=2**22, positive=False):
+    """
+    Histogram with fixed bins of the finite values of an array, accumulated
+    in chunks. Replaces full-array sorts when computing robust statistics.
+
+    data - Array (or memmap) of any shape
+    bins - Number of bins
+    vrange - (min, max) of the histogram. The default is the range of the
+             finite (and positive, if requested) values of the data
+    chunk - Number of elements read at a time
+    positive - Only use values larger than zero (e.g. to exclude off-limb
+               pixels of continuum images)
+    """
+    flat = data.reshape(-1)
+    if (vrange is None):
+        if (positive):
+            vrange = (0.0, chunked_range(data, chunk)[1])
+        else:
+            vrange = chunked_range(data, chunk)
+        if (not np.isfinite(vrange[0]) or vrange[0] == vrange[1]):
+            raise ValueError('Not enough valid values to build a histogram')
+
+    hist = np.zeros(bins, dtype='int64')
+    for start in range(0, flat.size, chunk):
+        block = np.asarray(flat[start:start+chunk], dtype='float64')
+        if (positive):
+            block = block[block > 0]
+        else:
+            block = block[np.isfinite(block)]
+        hist += np.histogram(block, bins=bins, range=vrange)[0]
+
+    edges = np.linspace(vrange[0], vrange[1], bins+1)
+    return hist, edges
+
+def histogram_mode(hist, edges, smooth=None):
+    """
+    Mode of a histogram, refined with a parabola through the peak bin and
+    its neighbours.
+
+    smooth - Width (in bins) of the boxcar applied before looking for the
+             peak, so that the counting noise of narrow bins does not bias
+             it. The default is 1/64 of the number of bins
+    """
+    if (smooth is None):
+        smooth = max(hist.size // 64, 1)
+    if (smooth > 1):
+        hist = np.convolve(hist, np.ones(smooth) / smooth, mode='same')
+
+    i = int(np.argmax(hist))
+    width = edges[1] - edges[0]
+    center = 0.5*(edges[i] + edges[i+1])
+    if (i == 0 or i == hist.size-1):
+        return center
+
+    left, peak, right = hist[i-1], hist[i], hist[i+1]
+    denom = left - 2.0*peak + right
+    if (denom == 0):
+        return center
+    return center + 0.5*width*(left - right)/denom
+
+def histogram_percentile(hist, edges, q):
+    """
+    Percentile q (in [0,100]) of a histogram, interpolating linearly inside
+    the bin where it falls.
+    """
+    cumulative = np.cumsum(hist)
+    target = q / 100.0 * cumulative[-1]
+    i = int(np.searchsorted(cumulative, target))
+    i = min(i, hist.size-1)
+    below = cumulative[i-1] if i > 0 else 0
+    fraction = (target - below) / hist[i] if hist[i] > 0 else 0.0
+    return edges[i] + fraction*(edges[i+1] - edges[i])
+
+def quiet_sun_level(data, method='mode', q=50.0, bins=2048, chunk=2**22, disk_fraction=0.3):
+    """
+    Quiet-Sun continuum intensity of an image or cube. The quiet Sun
+    dominates the distribution of on-disk intensities, so its level is the
+    mode (or a percentile) of the histogram of the on-disk pixels.
+
+    data - Continuum image or cube (memmaps are read in chunks)
+    method - 'mode' or 'percentile'
+    q - Percentile used with method='percentile'
+    disk_fraction - Pixels below this fraction of the 99th percentile of the
+                    positive values are considered off-limb (or dark
+                    umbrae) and are excluded. Full-disk images have many
+                    small positive values off the limb that would otherwise
+                    dominate the histogram
+    """
+    hist, edges = chunked_histogram(data, bins=bins, chunk=chunk, positive=True)
+    high = histogram_percentile(hist, edges, 99.0)
+    hist, edges = chunked_histogram(data, bins=bins, vrange=(disk_fraction*high, edges[-1]), chunk=chunk)
+    if (method == 'mode'):
+        return histogram_mode(hist, edges)
+    if (method == 'percentile'):
+        return histogram_percentile(hist, edges, q)
+    raise ValueError('Unknown method {0}'.format(method))
+
+def normalization_factor(data, ntype, header=None, kg_limit=10.0, **kwargs):
+    """
+    Factor that brings the input to the units expected by the networks:
+    continuum images normalized to the quiet Sun (I/Ic) and magnetograms in kG.
+
+    data - Image or cube
+    ntype - 'intensity' or 'blos'
+    header - FITS header used to find the units of the magnetogram (BUNIT).
+             Without BUNIT, the magnetogram is taken to be in kG if all its
+             values are below kg_limit in absolute value, and in G otherwise
+    kg_limit - Largest field (in absolute value) of a magnetogram in kG
+    """
+    if (ntype == 'intensity'):
+        return 1.0 / quiet_sun_level(data, **kwargs)
+    if (ntype == 'blos'):
+        unit = '' if header is None else str(header.get('BUNIT', '')).strip().lower()
+        if (unit in ['kg', 'kgauss', 'kilogauss']):
+            return 1.0
+        if (unit in ['g', 'gauss']):
+            return 1e-3
+        vmin, vmax = chunked_range(data)
+        if (max(abs(vmin), abs(vmax)) < kg_limit):
+            print('No BUNIT in the header, the magnetogram is assumed to be in kG (|B| < {0})'.format(kg_limit))
+            return 1.0
+        print('No BUNIT in the header, the magnetogram is assumed to be in G')
+        return 1e-3
+    raise ValueError('Unknown type {0}'.format(ntype))
@@ -0,0 +1,186 @@
+#Benchmarks of the DeepEM code in deepem.py
+import os
+import time
+import argparse
+import tempfile
+import torch
+import numpy as np
+import torch.nn as nn
+from torch.utils.data import DataLoader
+
+from deepem import cudaize, em_scale, img_scale, load_data, deepem_model, PixelEngine, DEMdata, train_parallel
+
+aia_files = ['AIA_DEM_2011-01-27','AIA_DEM_2011-02-22','AIA_DEM_2011-03-20']
+
+def get_data(path, size=512):
+    """
+    The DeepEM_Data observations if available. Otherwise random data with the
+    same shapes, which is enough to measure timings.
+    """
+    if all(os.path.exists(os.path.join(path, f + '.aia.npy')) for f in aia_files):
+        X, y, status, lgtaxis = load_data(aia_files, path=path)
+        return img_scale(X), em_scale(y), status
+    print('DeepEM_Data not found, using random data of {0}x{0} pixels'.format(size))
+    rng = np.random.RandomState(0)
+    X = rng.rand(len(aia_files), 6, size, size)
+    y = rng.rand(len(aia_files), 18, size, size)
+    status = np.zeros((len(aia_files), size, size))
+    return X, y, status
+
+class LegacyDEMdata(DEMdata):
+    """
+    Dataset of the original notebook: float64 arrays converted on every item.
+    """
+    def __init__(self, xtrain, ytrain, xtest, ytest, xval, yval, split='train'):
+        self.x = xtrain
+        self.y = ytrain
+
+    def __getitem__(self, index):
+        return torch.from_numpy(self.x[index]).type(torch.FloatTensor), torch.from_numpy(self.y[index]).type(torch.FloatTensor)
+
+def time_epochs(dataset, epochs):
+    torch.manual_seed(0)
+    model = cudaize(deepem_model())
+    optimizer = torch.optim.Adam(model.parameters(), lr=0.0001, weight_decay=1e-9)
+    criterion = cudaize(nn.MSELoss())
+    loader = DataLoader(dataset, batch_size=1)
+
+    # Warm-up epoch, not timed
+    times = []
+    for k in range(epochs+1):
+        start = time.time()
+        for img, dem in loader:
+            optimizer.zero_grad()
+            loss = criterion(model(cudaize(img)), cudaize(dem))
+            loss.backward()
+            optimizer.step()
+        times.append(time.time() - start)
+    return np.mean(times[1:])
+
+def bench_dataset(X, y, status, epochs):
+    """
+    Time per epoch of the training loop with the per-item conversion of the
+    original notebook and with the float32 tensors cached by DEMdata.
+    The arrays are float64, as those of the notebook, whatever load_data gives.
+    """
+    X = np.asarray(X, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    data = (X, y, X, y, X, y)
+
+    start = time.time()
+    dataset = LegacyDEMdata(*data, split='train')
+    for i in range(len(dataset)):
+        dataset[i]
+    item_legacy = (time.time() - start) / len(dataset)
+
+    start = time.time()
+    dataset = DEMdata(*data, split='train')
+    setup = time.time() - start
+    start = time.time()
+    for i in range(len(dataset)):
+        dataset[i]
+    item_cached = (time.time() - start) / len(dataset)
+
+    legacy = time_epochs(LegacyDEMdata(*data, split='train'), epochs)
+    cached = time_epochs(DEMdata(*data, split='train'), epochs)
+
+    print('Images per epoch          : {0}'.format(X.shape[0]))
+    print('Item access [ms]          : legacy {0:.3f} / cached {1:.3f}'.format(1e3*item_legacy, 1e3*item_cached))
+    print('One-off conversion [s]    : {0:.3f}'.format(setup))
+    print('Time per epoch [s]        : legacy {0:.3f} / cached {1:.3f} (x{2:.2f})'.format(legacy, cached, legacy / cached))
+    print('Estimate for 500 epochs [s]: legacy {0:.1f} / cached {1:.1f}'.format(500*legacy, 500*cached + setup))
+
+def bench_inference(X, chunk, repeat=3):
+    """
+    DEM solutions per second of the image-shaped convolutions (batch_size=1, as
+    in the notebook) and of the pixel-batched GEMM engine.
+    """
+    model = cudaize(deepem_model()).eval()
+    engine = PixelEngine(model, chunk=chunk)
+    npix = X.shape[0]*X.shape[2]*X.shape[3]
+
+    with torch.no_grad():
+        model(cudaize(torch.from_numpy(X[0:1]).float()))
+        start = time.time()
+        for r in range(repeat):
+            for i in range(X.shape[0]):
+                conv = model(cudaize(torch.from_numpy(X[i:i+1]).float())).cpu().numpy()
+        conv_time = (time.time() - start) / repeat
+
+    engine.predict(X[0:1])
+    start = time.time()
+    for r in range(repeat):
+        gemm = engine.predict(X)
+    gemm_time = (time.time() - start) / repeat
+
+    print('Pixels                    : {0}'.format(npix))
+    print('Max difference            : {0:.3e}'.format(np.abs(gemm[-1:] - conv).max()))
+    print('DEM solutions per second  : conv {0:.3e} / gemm {1:.3e} (x{2:.2f})'.format(npix / conv_time, npix / gemm_time, conv_time / gemm_time))
+
+def write_random_data(path, size):
+    """
+    Random .npy files with the layout of DeepEM_Data, for the benchmarks that
+    read the data from disk.
+    """
+    rng = np.random.RandomState(0)
+    for f in aia_files:
+        np.save(os.path.join(path, f + '.aia.npy'), rng.rand(6, size, size).astype(np.float32))
+        np.save(os.path.join(path, f + '.emcube.npy'), 1e25*rng.rand(18, size, size).astype(np.float32))
+        np.save(os.path.join(path, f + '.status.npy'), np.zeros((size, size), dtype=np.float32))
+
+def bench_parallel(path, size, epochs, max_procs, batch_size):
+    """
+    Scaling of the data-parallel training (train_parallel) with the number of
+    processes, with the cores shared evenly between them.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        if not all(os.path.exists(os.path.join(path, f + '.aia.npy')) for f in aia_files):
+            print('DeepEM_Data not found, using random data of {0}x{0} pixels'.format(size))
+            path = tmp
+            write_random_data(path, size)
+
+        world_sizes = [1]
+        while 2*world_sizes[-1] <= max_procs:
+            world_sizes.append(2*world_sizes[-1])
+
+        print('{0:>10s} {1:>16s} {2:>10s} {3:>12s}'.format('processes', 'epoch time [s]', 'speedup', 'efficiency'))
+        reference = None
+        for i, world_size in enumerate(world_sizes):
+            result = os.path.join(tmp, 'result.pth')
+            train_parallel(world_size, aia_files, [0], [1], path=path, pixels=True, batch_size=batch_size,
+                epochs=epochs, port=29500+i, model_file=None, result=result, val_every=epochs)
+            epoch_time = torch.load(result)['time'] / epochs
+            if reference is None:
+                reference = epoch_time
+            print('{0:10d} {1:16.3f} {2:10.2f} {3:12.2f}'.format(world_size, epoch_time, reference / epoch_time,
+                reference / epoch_time / world_size))
+
+if (__name__ == '__main__'):
+
+    parser = argparse.ArgumentParser(description='DeepEM benchmarks')
+    parser.add_argument('benchmark', help='Benchmark to run', choices=['dataset', 'inference', 'parallel'])
+    parser.add_argument('-p','--path', help='Directory with the DeepEM data', default='./DeepEM_Data/')
+    parser.add_argument('-s','--size', help='Image size of the random data used if DeepEM_Data is not available', type=int, default=512)
+    parser.add_argument('-e','--epochs', help='Number of timed epochs', type=int, default=5)
+    parser.add_argument('-c','--chunk', help='Pixels per chunk of the inference engine', type=int, default=2**18)
+    parser.add_argument('-n','--procs', help='Maximum number of processes of the parallel benchmark', type=int, default=len(os.sched_getaffinity(0)))
+    parser.add_argument('-b','--batch', help='Pixels per batch and process of the parallel benchmark', type=int, default=65536)
+    parsed = vars(parser.parse_args())
+
+    if (parsed['benchmark'] == 'parallel'):
+        bench_parallel(parsed['path'], parsed['size'], parsed['epochs'], parsed['procs'], parsed['batch'])
+        raise SystemExit
+
+    X, y, status = get_data(parsed['path'], parsed['size'])
+
+    if (parsed['benchmark'] == 'dataset'):
+        bench_dataset(X, y, status, parsed['epochs'])
+
+    if (parsed['benchmark'] == 'inference'):
+        bench_inference(X, parsed['chunk'])
+
+    # python benchmark.py dataset -e 5
+
+    # python benchmark.py inference -s 1024 -c 262144
+
+    # python benchmark.py parallel -n 16 -e 5
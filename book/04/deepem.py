@@ -0,0 +1,631 @@
+#This module collects the DeepEM code of the notebook so that it can be reused
+#outside of it (training scripts, inference on other AIA images, benchmarks)
+import os
+import time
+import torch
+import numpy as np
+import torch.nn as nn
+import torch.nn.functional as F
+import torch.distributed as dist
+from torch.utils.data import Dataset, DataLoader
+from torch.utils.data.distributed import DistributedSampler
+from torch.nn.parallel import DistributedDataParallel
+
+#cudaize determines if a gpu is available for training and testing
+def cudaize(obj):
+    return obj.cuda() if torch.cuda.is_available() else obj
+
+def em_scale(y):
+    return np.sqrt(y/1e25)
+
+def em_unscale(y):
+    return 1e25*(y*y)
+
+def img_scale(x):
+    x2 = x
+    bad = np.where(x2 <= 0.0)
+    x2[bad] = 0.0
+    return np.sqrt(x2)
+
+def img_unscale(x):
+    return x*x
+
+def open_float32(filename, cache_dir=None):
+    """
+    Open a .npy file as a read-only memmap. Files stored with another dtype
+    are left as they are and converted to float32 as they are read, unless
+    cache_dir is given: then they are converted once, frame by frame, to a
+    float32 copy in cache_dir (<name>.float32.npy) that is reused afterwards.
+    """
+    array = np.load(filename, mmap_mode='r')
+    if array.dtype == np.float32 or cache_dir is None:
+        return array
+
+    name = os.path.basename(filename)[:-len('.npy')] + '.float32.npy'
+    cached = os.path.join(cache_dir, name)
+    if not os.path.exists(cached) or os.path.getmtime(cached) < os.path.getmtime(filename):
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = cached + '.tmp'
+        out = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.float32, shape=array.shape)
+        for i in range(array.shape[0]):
+            out[i] = array[i]
+        out.flush()
+        del out
+        os.replace(tmp, cached)
+    return np.load(cached, mmap_mode='r')
+
+class LazyStack(object):
+    """
+    Stack of .npy files with the same shape, opened as memmaps and read as
+    float32. Nothing is read until the stack is indexed: an integer gives one
+    file (its memmap if it is stored as float32) and a slice reads and stacks
+    the requested files.
+    """
+    def __init__(self, filenames, cache_dir=None):
+        self.filenames = list(filenames)
+        self.arrays = [open_float32(f, cache_dir) for f in self.filenames]
+        shapes = set([a.shape for a in self.arrays])
+        if len(shapes) != 1:
+            raise ValueError('Arrays have different shapes: {0}'.format(sorted(shapes)))
+        self.shape = (len(self.arrays),) + self.arrays[0].shape
+        self.ndim = len(self.shape)
+        self.dtype = np.dtype(np.float32)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def read(self, i, rest=()):
+        array = self.arrays[i][rest]
+        if array.dtype != np.float32:
+            array = array.astype(np.float32)
+        return array
+
+    def pixels(self, i, pixels):
+        """
+        (channels, n) float32 values of the pixels (flat indices or a slice) of
+        file i. They are selected in the memmap before the conversion, so only
+        the requested pixels are read and converted.
+        """
+        array = self.arrays[i]
+        return np.asarray(array.reshape(array.shape[0], -1)[:,pixels], dtype=np.float32)
+
+    def __getitem__(self, index):
+        if isinstance(index, tuple):
+            first, rest = index[0], index[1:]
+        else:
+            first, rest = index, ()
+        if isinstance(first, slice):
+            files = range(*first.indices(len(self)))
+            if len(files) == 0:
+                return np.empty((0,) + self.shape[1:], dtype=np.float32)[(slice(None),) + rest]
+            out = None
+            for k, i in enumerate(files):
+                # One file at a time, so only one of them is ever converted in memory
+                array = self.read(i, rest)
+                if out is None:
+                    out = np.empty((len(files),) + array.shape, dtype=np.float32)
+                out[k] = array
+            return out
+        return self.read(int(first), rest)
+
+    def __array__(self, dtype=None, copy=None):
+        out = self[:]
+        return out if dtype is None else out.astype(dtype)
+
+def read_pixels(X, i, pixels):
+    """
+    (channels, n) float32 values of the pixels (flat indices or a slice) of
+    image i of X, an array, memmap or LazyStack
+    """
+    if isinstance(X, LazyStack):
+        return X.pixels(i, pixels)
+    image = X[i]
+    return np.asarray(image.reshape(image.shape[0], -1)[:,pixels], dtype=np.float32)
+
+def load_data(aia_files, path='./DeepEM_Data/', mmap=False, cache_dir=None):
+    """
+    Load the SDO/AIA images, Basis Pursuit DEMs and status maps of a list of
+    observations (e.g. 'AIA_DEM_2011-01-27').
+
+    Returns X (n, 6, N, N), y (n, 18, N, N), status (n, N, N) and the
+    log10(T) axis of the DEM bins, all as float32. With mmap=True the first
+    three are LazyStacks of memmaps, so that training sets larger than the
+    memory can be used (see LazyDEMdata). Otherwise they are read once into
+    memory. Nothing is written to path.
+
+    cache_dir - Optional directory for float32 copies of the files stored with
+                another dtype, so that they are not converted again on every read
+    """
+    X = LazyStack([os.path.join(path, f + '.aia.npy') for f in aia_files], cache_dir)
+    y = LazyStack([os.path.join(path, f + '.emcube.npy') for f in aia_files], cache_dir)
+    status = LazyStack([os.path.join(path, f + '.status.npy') for f in aia_files], cache_dir)
+
+    lgtaxis = np.arange(y.shape[1])*0.1 + 5.5
+
+    if not mmap:
+        X, y, status = X[:], y[:], status[:]
+
+    return X, y, status, lgtaxis
+
+def deepem_model():
+    """
+    1x1 2D CNN with a single hidden layer: each pixel of the 6 SDO/AIA
+    channels (6 x 1 x 1) is mapped to its DEM (18 x 1 x 1).
+    """
+    return nn.Sequential(
+        nn.Conv2d(6, 300, kernel_size=1),
+        nn.LeakyReLU(),
+        nn.Conv2d(300, 300, kernel_size=1),
+        nn.LeakyReLU(),
+        nn.Conv2d(300, 18, kernel_size=1))
+
+class PixelEngine(object):
+    """
+    Inference engine for the DeepEM model. Since all the layers are 1x1
+    convolutions, each pixel is an independent 6 -> 300 -> 300 -> 18 MLP, so
+    all the pixels of any number of images are evaluated as a (6, n_pixels)
+    matrix with plain GEMMs, in chunks of a fixed number of pixels. Memory is
+    bounded by the chunk size, whatever the size and number of the images.
+    """
+    def __init__(self, model, chunk=2**18):
+        self.chunk = chunk
+        self.layers = []
+        for layer in model:
+            if isinstance(layer, nn.Conv2d):
+                weight = layer.weight.detach()[:,:,0,0].float().contiguous()
+                bias = layer.bias.detach().float()[:,None]
+                self.layers.append(('linear', cudaize(weight), cudaize(bias)))
+            elif isinstance(layer, nn.LeakyReLU):
+                self.layers.append(('leaky_relu', layer.negative_slope, None))
+            else:
+                raise ValueError('Layer {0} is not supported'.format(layer))
+        self.n_in = self.layers[0][1].shape[1]
+        self.n_out = [l for l in self.layers if l[0] == 'linear'][-1][1].shape[0]
+
+    def forward(self, x):
+        """
+        x - (6, n_pixels) tensor, returns (18, n_pixels)
+        """
+        for kind, a, b in self.layers:
+            if kind == 'linear':
+                x = torch.addmm(b, a, x)
+            else:
+                x = F.leaky_relu(x, a)
+        return x
+
+    def predict(self, X, out=None, scale=False):
+        """
+        X - (n, 6, ny, nx) scaled SDO/AIA images (arrays, memmaps or LazyStacks)
+        out - Optional (n, 18, ny, nx) float32 array (or memmap) for the output
+        scale - X are the raw images: img_scale is applied to each chunk of
+                pixels as it is read, so that X is neither modified nor copied
+
+        Returns the scaled DEMs (n, 18, ny, nx), as model(X) would.
+        """
+        n, nc, ny, nx = X.shape
+        if nc != self.n_in:
+            raise ValueError('Expected {0} channels, got {1}'.format(self.n_in, nc))
+        npix = ny*nx
+        if out is None:
+            out = np.empty((n, self.n_out, ny, nx), dtype='float32')
+
+        y = out.reshape(n, self.n_out, npix)
+
+        with torch.no_grad():
+            for start in range(0, n*npix, self.chunk):
+                stop = min(start + self.chunk, n*npix)
+
+                # A chunk of pixels can span several consecutive images
+                segments = []
+                for i in range(start // npix, (stop - 1) // npix + 1):
+                    segments.append((i, max(start - i*npix, 0), min(stop - i*npix, npix)))
+
+                # Only the pixels of the chunk are read (and converted, for LazyStacks)
+                block = np.concatenate([read_pixels(X, i, slice(s, e)) for i, s, e in segments], axis=1)
+                block = np.ascontiguousarray(block, dtype=np.float32)
+                if scale:
+                    # block is always a copy of X, img_scale can work in place
+                    block = img_scale(block)
+                block = cudaize(torch.from_numpy(block))
+                pred = self.forward(block).cpu().numpy()
+
+                offset = 0
+                for i, s, e in segments:
+                    y[i,:,s:e] = pred[:,offset:offset+e-s]
+                    offset += e-s
+
+        return out
+
+class PixelMLP(nn.Module):
+    """
+    The DeepEM model with its 1x1 convolutions replaced by the equivalent
+    linear layers acting on the channels of every pixel. Same input and output
+    as the original model, (n, 6, ny, nx) -> (n, 18, ny, nx), but the linear
+    layers can be dynamically quantized and the module scripted for inference.
+    """
+    def __init__(self, model):
+        super(PixelMLP, self).__init__()
+        layers = []
+        for layer in model:
+            if isinstance(layer, nn.Conv2d):
+                linear = nn.Linear(layer.in_channels, layer.out_channels)
+                linear.weight.data.copy_(layer.weight.detach()[:,:,0,0])
+                linear.bias.data.copy_(layer.bias.detach())
+                layers.append(linear)
+            elif isinstance(layer, nn.LeakyReLU):
+                layers.append(nn.LeakyReLU(layer.negative_slope))
+            else:
+                raise ValueError('Layer {0} is not supported'.format(layer))
+        self.mlp = nn.Sequential(*layers)
+
+    def forward(self, x):
+        n, c, ny, nx = x.shape
+        y = self.mlp(x.permute(0, 2, 3, 1).reshape(-1, c))
+        return y.reshape(n, ny, nx, -1).permute(0, 3, 1, 2)
+
+def export_model(model, filename, quantize=False):
+    """
+    Save a TorchScript version of the model for inference, which can be loaded
+    with torch.jit.load without the code of this module. With quantize=True
+    the weights of the linear layers are stored as int8 and the activations are
+    quantized dynamically (CPU only).
+    """
+    module = PixelMLP(model.cpu()).eval()
+    if quantize:
+        module = torch.ao.quantization.quantize_dynamic(module, {nn.Linear}, dtype=torch.qint8)
+    scripted = torch.jit.script(module)
+    scripted.save(filename)
+    return scripted
+
+class DEMdata(Dataset):
+    """
+    Training, validation or test split of the SDO/AIA images and DEMs.
+
+    The arrays are converted once to contiguous float32 tensors, so that each
+    item is a view instead of a new float64 -> float32 copy on every epoch.
+    """
+    def __init__(self, xtrain, ytrain, xtest, ytest, xval, yval, split='train'):
+
+        if split == 'train':
+            x, y = xtrain, ytrain
+        if split == 'val':
+            x, y = xval, yval
+        if split == 'test':
+            x, y = xtest, ytest
+
+        self.x = torch.from_numpy(np.ascontiguousarray(x, dtype=np.float32))
+        self.y = torch.from_numpy(np.ascontiguousarray(y, dtype=np.float32))
+
+    def __getitem__(self, index):
+        return self.x[index], self.y[index]
+
+    def __len__(self):
+        return self.x.shape[0]
+
+class LazyDEMdata(Dataset):
+    """
+    Images and DEMs read on demand from the memmaps returned by load_data with
+    mmap=True, and scaled (img_scale/em_scale) as each item is requested.
+
+    indices - Images of the split (e.g. [0] for training). All by default
+    """
+    def __init__(self, x, y, indices=None):
+        self.x = x
+        self.y = y
+        self.indices = list(range(len(x))) if indices is None else list(indices)
+
+    def __getitem__(self, index):
+        i = self.indices[index]
+        x = img_scale(np.array(self.x[i], dtype=np.float32))
+        y = em_scale(np.array(self.y[i], dtype=np.float32)).astype(np.float32)
+        return torch.from_numpy(x), torch.from_numpy(y)
+
+    def __len__(self):
+        return len(self.indices)
+
+class PixelSampler(object):
+    """
+    Shuffled minibatches of single pixels for training the per-pixel DeepEM
+    model. Only the pixels where Basis Pursuit found a solution (status == 0)
+    are used, indexed once across all the images, and each batch is gathered
+    from the (memmapped) arrays in sorted order to keep the reads local.
+
+    Batches are (batch_size, 6, 1, 1) images and (batch_size, 18, 1, 1) DEMs,
+    scaled with img_scale/em_scale, so the sampler can replace a DataLoader in
+    train_model.
+
+    X, y, status - Arrays or LazyStacks returned by load_data
+    indices - Images used (e.g. [0] for the training split). All by default
+    rank, world_size - For data-parallel training, each rank keeps a disjoint
+                       random shard of the valid pixels, all of the same size
+                       so that every rank runs the same number of batches
+    """
+    def __init__(self, X, y, status, batch_size=65536, indices=None, shuffle=True, seed=None, rank=0, world_size=1):
+        self.X = X
+        self.y = y
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.random = np.random.RandomState(seed)
+        self.n_in = X.shape[1]
+        self.n_out = y.shape[1]
+        self.npix = X.shape[2]*X.shape[3]
+
+        if indices is None:
+            indices = range(X.shape[0])
+        valid = [i*self.npix + np.flatnonzero(np.asarray(status[i]).reshape(-1) == 0) for i in indices]
+        self.index = np.concatenate(valid).astype(np.int64)
+        if rank == 0:
+            print('Valid pixels : {0}'.format(self.index.size))
+
+        if world_size > 1:
+            # Same order in every rank, whatever the seed of the batches
+            order = np.random.RandomState(0 if seed is None else seed).permutation(self.index.size)
+            n = self.index.size // world_size
+            self.index = np.sort(self.index[order[rank*n:(rank+1)*n]])
+
+    def __len__(self):
+        return (self.index.size + self.batch_size - 1) // self.batch_size
+
+    def gather(self, index):
+        index = np.sort(index)
+        image = index // self.npix
+        pixel = index % self.npix
+
+        x = np.empty((index.size, self.n_in), dtype=np.float32)
+        y = np.empty((index.size, self.n_out), dtype=np.float32)
+        bounds = np.flatnonzero(np.diff(image)) + 1
+        for s, e in zip(np.r_[0, bounds], np.r_[bounds, index.size]):
+            i = image[s]
+            # Only the pixels of the batch are read and converted
+            x[s:e] = read_pixels(self.X, i, pixel[s:e]).T
+            y[s:e] = read_pixels(self.y, i, pixel[s:e]).T
+
+        x = img_scale(x)
+        y = em_scale(y).astype(np.float32)
+        return torch.from_numpy(x[:,:,None,None]), torch.from_numpy(y[:,:,None,None])
+
+    def __iter__(self):
+        if self.shuffle:
+            order = self.random.permutation(self.index.size)
+        else:
+            order = np.arange(self.index.size)
+        for start in range(0, self.index.size, self.batch_size):
+            yield self.gather(self.index[order[start:start+self.batch_size]])
+
+def save_checkpoint(filename, state):
+    """
+    Save a training checkpoint, writing it first to a temporary file so that a
+    crash while saving never leaves a broken checkpoint behind.
+    """
+    torch.save(state, filename + '.tmp')
+    os.replace(filename + '.tmp', filename)
+
+def epoch_mean(batch_losses):
+    """
+    Mean of the batch losses of an epoch, across all the processes in
+    data-parallel training (every process has to call it)
+    """
+    if not (dist.is_available() and dist.is_initialized()):
+        return float(batch_losses.mean())
+    total = torch.tensor([batch_losses.sum(), batch_losses.size], dtype=torch.float64)
+    dist.all_reduce(total)
+    return float(total[0] / total[1])
+
+def truncate_log(log_file, first_epoch):
+    """
+    Keep only the header and the rows of the epochs before first_epoch of a
+    CSV log written by train_model
+    """
+    with open(log_file) as f, open(log_file + '.tmp', 'w') as out:
+        out.write(f.readline())
+        for line in f:
+            if int(line.split(',', 1)[0]) < first_epoch:
+                out.write(line)
+    os.replace(log_file + '.tmp', log_file)
+
+def train_model(model, dem_loader, criterion, optimizer, dem_loader_val, epochs=500, val_every=1,
+        checkpoint=None, checkpoint_every=10, resume=False, patience=None, log_file=None, model_file='DeepEM_CNN_HelioML.pth',
+        main_process=True):
+    """
+    Train the model, validating it every `val_every` epochs (and after the
+    last one).
+
+    dem_loader_val - Loader of the validation set, created once for the whole
+                     run. Validation images can (and should) be batched
+    checkpoint - File where the model, the optimizer state and the loss history
+                 are saved every `checkpoint_every` epochs
+    resume - Continue from `checkpoint` if it exists
+    patience - Stop after this number of validations without improving the
+               best validation loss, keeping the best model. None trains for
+               all the epochs and keeps the last model
+    log_file - CSV file where the loss of every batch (and every validation)
+               is appended at the end of each epoch. An existing log is cut
+               back to the epochs before the first one trained
+    model_file - File where the final model is saved (None to skip it)
+    main_process - In data-parallel training only the main process prints,
+                   writes logs and saves checkpoints. The others still read
+                   the checkpoint when resuming. The training loss of each
+                   epoch is averaged over the batches of all the processes,
+                   the CSV log has the batches of the main process
+
+    Returns the training loss of each epoch and the validation loss (NaN for
+    the epochs without validation).
+    """
+    model.train()
+    train_loss_epoch = []
+    train_val = []
+    first_epoch = 0
+    best_val = np.inf
+    best_state = None
+    bad_validations = 0
+
+    if resume and checkpoint is not None and os.path.exists(checkpoint):
+        state = torch.load(checkpoint, map_location=lambda storage, loc: storage)
+        model.load_state_dict(state['state_dict'])
+        optimizer.load_state_dict(state['optimizer'])
+        train_loss_epoch = state['train_loss']
+        train_val = state['val_loss']
+        best_val = state['best_val']
+        best_state = state['best_state']
+        bad_validations = state['bad_validations']
+        first_epoch = state['epoch'] + 1
+        if main_process:
+            print('Resuming from epoch {0}'.format(first_epoch))
+
+    if not main_process:
+        log_file = None
+
+    if log_file is not None and os.path.exists(log_file):
+        # Epochs after the checkpoint were logged but are trained again
+        truncate_log(log_file, first_epoch)
+    elif log_file is not None:
+        with open(log_file, 'w') as f:
+            f.write('epoch,batch,split,loss\n')
+
+    for k in range(first_epoch, epochs):
+        batch_losses = []
+        # =================== progress indicator ==============
+        if main_process and k % max((epochs + 1) // 4, 1) == 0:
+            print('[{0}]: {1:.1f}% complete: '.format(k, k / epochs * 100))
+        # =====================================================
+        for img, dem in dem_loader:
+            optimizer.zero_grad()
+            # =================== forward =====================
+            img = cudaize(img)
+            dem = cudaize(dem)
+            output = model(img)
+            loss = criterion(output, dem)
+            loss.backward()
+            optimizer.step()
+
+            batch_losses.append(loss.detach())
+        # Only one copy of the losses to the host per epoch
+        batch_losses = torch.stack(batch_losses).cpu().numpy()
+        # =================== Validation ===================
+        if (k % val_every == 0) or (k == epochs - 1):
+            val_loss, dummy, dem_pred_val, dem_in_test_val = valtest_model(model, dem_loader_val, criterion)
+            model.train()
+            if val_loss < best_val:
+                best_val = val_loss
+                best_state = {key: value.detach().cpu().clone() for key, value in model.state_dict().items()}
+                bad_validations = 0
+            else:
+                bad_validations += 1
+        else:
+            val_loss = np.nan
+
+        train_loss_epoch.append(epoch_mean(batch_losses))
+        train_val.append(val_loss)
+
+        if log_file is not None:
+            with open(log_file, 'a') as f:
+                for i, loss in enumerate(batch_losses):
+                    f.write('{0},{1},train,{2}\n'.format(k, i, loss))
+                if not np.isnan(val_loss):
+                    f.write('{0},,val,{1}\n'.format(k, val_loss))
+
+        if main_process and k%10 == 0:
+            print('Epoch: ', k, 'trn_loss: ', train_loss_epoch[k], 'val_loss: ', train_val[k])
+
+        stop = patience is not None and bad_validations >= patience
+
+        if main_process and checkpoint is not None and ((k + 1) % checkpoint_every == 0 or k == epochs - 1 or stop):
+            save_checkpoint(checkpoint, {'epoch': k, 'state_dict': model.state_dict(), 'optimizer': optimizer.state_dict(),
+                'train_loss': train_loss_epoch, 'val_loss': train_val, 'best_val': best_val, 'best_state': best_state,
+                'bad_validations': bad_validations})
+
+        if stop:
+            if main_process:
+                print('Early stopping at epoch {0}: no improvement in {1} validations'.format(k, patience))
+            break
+
+    if patience is not None and best_state is not None:
+        model.load_state_dict(best_state)
+
+    if main_process and model_file is not None:
+        torch.save(model.state_dict(), model_file)
+    return train_loss_epoch, train_val
+
+def _train_rank(rank, world_size, aia_files, path, train_indices, val_indices, pixels, batch_size, epochs, lr, threads, seed, port, model_file, result, kwargs):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    torch.set_num_threads(threads)
+    torch.manual_seed(seed)
+
+    X, y, status, lgtaxis = load_data(aia_files, path=path, mmap=True)
+    if pixels:
+        dem_loader = PixelSampler(X, y, status, batch_size=batch_size, indices=train_indices, seed=seed, rank=rank, world_size=world_size)
+    else:
+        dem_data = LazyDEMdata(X, y, train_indices)
+        dem_loader = DataLoader(dem_data, batch_size=batch_size, sampler=DistributedSampler(dem_data, world_size, rank, shuffle=False))
+    dem_loader_val = DataLoader(LazyDEMdata(X, y, val_indices), batch_size=len(val_indices))
+
+    # DistributedDataParallel starts every rank from the weights of rank 0 and
+    # all-reduces (averages) the gradients in backward
+    model = DistributedDataParallel(deepem_model())
+    optimizer = torch.optim.Adam(model.parameters(), lr=lr, weight_decay=1e-9)
+    criterion = nn.MSELoss()
+
+    start = time.time()
+    train_loss, valdn_loss = train_model(model, dem_loader, criterion, optimizer, dem_loader_val, epochs=epochs,
+        model_file=None, main_process=(rank == 0), **kwargs)
+    elapsed = time.time() - start
+
+    if rank == 0:
+        if model_file is not None:
+            torch.save(model.module.state_dict(), model_file)
+        if result is not None:
+            torch.save({'train_loss': train_loss, 'val_loss': valdn_loss, 'time': elapsed, 'world_size': world_size}, result)
+
+    dist.destroy_process_group()
+
+def train_parallel(world_size, aia_files, train_indices, val_indices, path='./DeepEM_Data/', pixels=True, batch_size=65536,
+        epochs=500, lr=0.0001, threads=None, seed=0, port=29500, model_file='DeepEM_CNN_HelioML.pth', result=None, **kwargs):
+    """
+    Data-parallel training of DeepEM on CPU with `world_size` processes on this
+    machine (torch.distributed with the gloo backend). Every process opens the
+    data as memmaps and trains on its own shard of the pixels (PixelSampler)
+    or images (DistributedSampler); gradients are averaged across processes
+    in every step, so all of them keep the same model.
+
+    train_indices, val_indices - Images of aia_files used for training and validation
+    pixels - Train on minibatches of valid pixels instead of whole images
+    batch_size - Pixels (or images) per batch and process
+    threads - Torch threads per process. By default the cores are shared evenly
+    result - File where rank 0 saves the loss history and the training time
+    kwargs - Passed to train_model (val_every, checkpoint, resume, patience, log_file...)
+    """
+    if threads is None:
+        threads = max(len(os.sched_getaffinity(0)) // world_size, 1)
+
+    torch.multiprocessing.spawn(_train_rank, nprocs=world_size, join=True,
+        args=(world_size, aia_files, path, list(train_indices), list(val_indices), pixels, batch_size, epochs, lr, threads, seed, port, model_file, result, kwargs))
+
+def valtest_model(model, dem_loader, criterion):
+    """
+    Loss of the model over a loader. The losses are accumulated on the device
+    and only copied to the host once all the batches have been evaluated.
+
+    Returns the mean loss per image, the loss of each batch and the
+    prediction and target of the last batch.
+    """
+    model.eval()
+
+    val_loss = 0
+    count = 0
+    test_loss = []
+    with torch.no_grad():
+        for img, dem in dem_loader:
+            count += img.shape[0]
+            # =================== forward =====================
+            img = cudaize(img)
+            dem = cudaize(dem)
+
+            output = model(img)
+            loss = criterion(output, dem)
+            test_loss.append(loss)
+            val_loss = val_loss + loss*img.shape[0]
+
+    test_loss = torch.stack(test_loss).tolist()
+    return float(val_loss)/count, test_loss, output, dem
@@ -0,0 +1,176 @@
+#Vectorized diagnostics of DEM cubes. All the functions take (n_images, 18, ny, nx)
+#cubes of emission measure (arrays or memmaps, e.g. the output of
+#PixelEngine.predict unscaled with em_unscale), read them a few images at a time
+#and reduce over the temperature bins and pixels with float32 accumulators
+import numpy as np
+
+def _blocks(cube, images):
+    for start in range(0, cube.shape[0], images):
+        yield start, np.asarray(cube[start:start+images], dtype=np.float32)
+
+def _mask(status, start, stop):
+    # Pixels where Basis Pursuit obtained a solution
+    return (np.asarray(status[start:stop]) == 0).astype(np.float32)
+
+def total_em(em, images=1):
+    """
+    Total emission measure of each pixel, (n_images, ny, nx).
+    """
+    out = np.empty((em.shape[0],) + em.shape[2:], dtype=np.float32)
+    for start, block in _blocks(em, images):
+        out[start:start+block.shape[0]] = block.sum(axis=1, dtype=np.float32)
+    return out
+
+def mean_temperature(em, lgtaxis, images=1):
+    """
+    EM-weighted mean log10(T) of each pixel, (n_images, ny, nx). NaN where the
+    total EM is zero.
+    """
+    lgtaxis = np.asarray(lgtaxis, dtype=np.float32)
+    out = np.empty((em.shape[0],) + em.shape[2:], dtype=np.float32)
+    for start, block in _blocks(em, images):
+        total = block.sum(axis=1, dtype=np.float32)
+        weighted = np.tensordot(lgtaxis, block, axes=([0], [1]))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            out[start:start+block.shape[0]] = np.where(total > 0, weighted / total, np.nan)
+    return out
+
+def mean_em(em, status, images=1):
+    """
+    Mean emission measure in each temperature bin over the pixels with a Basis
+    Pursuit solution (status == 0), (n_images, 18). This is the curve of
+    PlotTotalEM in the notebook.
+    """
+    out = np.empty(em.shape[0:2], dtype=np.float32)
+    for start, block in _blocks(em, images):
+        stop = start + block.shape[0]
+        mask = _mask(status, start, stop)
+        nmask = mask.sum(axis=(1, 2), dtype=np.float32)
+        out[start:stop] = np.einsum('ntyx,nyx->nt', block, mask) / nmask[:,None]
+    return out
+
+def residual_stats(em_true, em_pred, status=None, unit=1e25, images=1):
+    """
+    Statistics of the residuals (em_pred - em_true) / unit in each temperature
+    bin, accumulated over all the images and the valid pixels (status == 0, or
+    all of them if status is None). The unit keeps the squares of the EM
+    within the range of float32.
+
+    Returns a dictionary with the number of pixels and the bias, mean absolute
+    error and rms error of each bin, (18,).
+    """
+    nbins = em_true.shape[1]
+    count = np.float32(0.0)
+    total = np.zeros(nbins, dtype=np.float32)
+    total_abs = np.zeros(nbins, dtype=np.float32)
+    total_sq = np.zeros(nbins, dtype=np.float32)
+
+    for start, block in _blocks(em_true, images):
+        stop = start + block.shape[0]
+        residual = (np.asarray(em_pred[start:stop], dtype=np.float32) - block) / np.float32(unit)
+        if status is None:
+            mask = np.ones((block.shape[0],) + block.shape[2:], dtype=np.float32)
+        else:
+            mask = _mask(status, start, stop)
+        count += mask.sum(dtype=np.float32)
+        total += np.einsum('ntyx,nyx->t', residual, mask)
+        total_abs += np.einsum('ntyx,nyx->t', np.abs(residual), mask)
+        total_sq += np.einsum('ntyx,nyx->t', residual*residual, mask)
+
+    return {'count': count,
+        'bias': total / count,
+        'mae': total_abs / count,
+        'rms': np.sqrt(total_sq / count)}
+
+def load_response(filename='./DeepEM_Data/AIA_Resp.npy'):
+    """
+    AIA temperature responses as a (6, 18) float32 matrix (the weights of
+    dem2aia in the notebook are stored as (6, 18, 1, 1)).
+    """
+    response = np.load(filename)
+    return response.reshape(response.shape[0], response.shape[1]).astype(np.float32)
+
+def forward_project(em, response, out=None, images=1, rows=None):
+    """
+    Synthetic AIA intensities of the EM cube, (n_images, 6, ny, nx), with one
+    contraction of the (6, 18) response matrix per block of images and rows.
+    out - Optional output array (e.g. a memmap), allocated if None
+    rows - Rows per block, None for whole images. Full-disk cubes can be
+    streamed through a bounded amount of memory with rows of a few hundred
+    """
+    response = np.asarray(response, dtype=np.float32)
+    n, nbins, ny, nx = em.shape
+    rows = ny if rows is None else rows
+    if out is None:
+        out = np.empty((n, response.shape[0], ny, nx), dtype=np.float32)
+
+    for start in range(0, n, images):
+        for y0 in range(0, ny, rows):
+            block = np.asarray(em[start:start+images, :, y0:y0+rows], dtype=np.float32)
+            nimg, _, nrow, _ = block.shape
+            synthetic = np.matmul(response, block.reshape(nimg, nbins, nrow*nx))
+            out[start:start+nimg, :, y0:y0+nrow] = synthetic.reshape(nimg, -1, nrow, nx)
+    return out
+
+def chi2_map(em, aia, response, sigma=None, floor=1.0, synthetic=None, out=None, images=1, rows=None):
+    """
+    Reduced chi^2 of each pixel between the AIA observations and the intensities
+    synthesized from the EM cube, (n_images, ny, nx).
+    aia - Observed (unscaled, img_unscale) intensities, (n_images, 6, ny, nx)
+    sigma - Uncertainty of each channel, (6,) or an array with the shape of aia.
+    If None, shot noise plus a floor: sigma^2 = max(aia, 0) + floor^2
+    synthetic - Optional output array for the synthetic intensities
+    out - Optional output array (e.g. a memmap) for the chi^2 maps, allocated if None
+    """
+    response = np.asarray(response, dtype=np.float32)
+    n, nbins, ny, nx = em.shape
+    nchan = response.shape[0]
+    rows = ny if rows is None else rows
+    # Per-pixel uncertainties are read block by block, like aia
+    per_pixel = sigma is not None and np.ndim(sigma) == 4
+    if sigma is not None and not per_pixel:
+        sigma = np.asarray(sigma, dtype=np.float32).reshape(1, -1, 1, 1)
+    if out is None:
+        out = np.empty((n, ny, nx), dtype=np.float32)
+
+    for start in range(0, n, images):
+        stop = min(start + images, n)
+        for y0 in range(0, ny, rows):
+            y1 = min(y0 + rows, ny)
+            block = np.asarray(em[start:stop, :, y0:y1], dtype=np.float32)
+            model = np.matmul(response, block.reshape(stop-start, nbins, -1)).reshape(stop-start, nchan, y1-y0, nx)
+            if synthetic is not None:
+                synthetic[start:stop, :, y0:y1] = model
+            obs = np.asarray(aia[start:stop, :, y0:y1], dtype=np.float32)
+            if sigma is None:
+                variance = np.maximum(obs, 0.0) + np.float32(floor*floor)
+            elif per_pixel:
+                variance = np.asarray(sigma[start:stop, :, y0:y1], dtype=np.float32)**2
+            else:
+                variance = sigma*sigma
+            residual = model - obs
+            out[start:stop, y0:y1] = (residual*residual / variance).sum(axis=1, dtype=np.float32) / nchan
+    return out
+
+def plot_mean_em(em_true, em_pred, lgtaxis, status, index=0):
+    """
+    Mean emission measure of the truth and the prediction for one image, as
+    PlotTotalEM in the notebook.
+    """
+    import matplotlib.pyplot as plt
+
+    EM_tru_sum = mean_em(em_true[index:index+1], status[index:index+1])[0]
+    EM_inv_sum = mean_em(em_pred[index:index+1], status[index:index+1])[0]
+
+    plt.plot(lgtaxis, EM_tru_sum, linewidth=3, color="black")
+    plt.plot(lgtaxis, EM_inv_sum, linewidth=3, color="lightblue", linestyle='--')
+
+    dlogT = lgtaxis[1]-lgtaxis[0]
+    plt.xlim(lgtaxis[0]-0.5*dlogT, lgtaxis.max()+0.5*dlogT)
+    plt.xticks(np.arange(np.min(lgtaxis), np.max(lgtaxis), 2*dlogT))
+    plt.ylim(1e24, 1e27)
+    plt.yscale('log')
+    plt.xlabel('log$_{10}$T [K]')
+    plt.ylabel('Mean Emission Measure [cm$^{-5}$]')
+    plt.show()
+    return EM_inv_sum, EM_tru_sum
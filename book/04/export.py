@@ -0,0 +1,92 @@
+#Export of the trained DeepEM model for operational inference: a TorchScript
+#artifact and, optionally, its dynamically quantized (int8) variant, with an
+#accuracy report against the float model and a CPU throughput comparison
+import os
+import time
+import argparse
+import torch
+import numpy as np
+
+from deepem import em_unscale, img_scale, deepem_model, export_model
+
+aia_files = ['AIA_DEM_2011-01-27','AIA_DEM_2011-02-22','AIA_DEM_2011-03-20']
+
+def get_samples(path, size=512):
+    """
+    Scaled SDO/AIA images and status maps of the DeepEM_Data samples. When the
+    AIA images are not available, random images with the range of the scaled
+    AIA data are used with the bundled status maps.
+    """
+    status = np.array([np.load(os.path.join(path, f + '.status.npy')) for f in aia_files])
+    if all(os.path.exists(os.path.join(path, f + '.aia.npy')) for f in aia_files):
+        X = np.array([np.load(os.path.join(path, f + '.aia.npy')) for f in aia_files], dtype=np.float32)
+        return img_scale(X), status
+    print('AIA images not found in {0}, using random images'.format(path))
+    rng = np.random.RandomState(0)
+    X = 5.0*rng.rand(len(aia_files), 6, status.shape[1], status.shape[2]).astype(np.float32)
+    return X, status
+
+def throughput(model, X, repeat):
+    with torch.no_grad():
+        model(X[0:1])
+        start = time.time()
+        for r in range(repeat):
+            out = torch.cat([model(X[i:i+1]) for i in range(X.shape[0])])
+    elapsed = (time.time() - start) / repeat
+    return out, X.shape[0]*X.shape[2]*X.shape[3] / elapsed
+
+def report(reference, out, status):
+    """
+    Errors of `out` with respect to `reference` (both scaled DEMs), in the
+    scaled units and in relative emission measure, for the pixels with a
+    Basis Pursuit solution (status == 0).
+    """
+    valid = torch.from_numpy(status == 0)[:,None,:,:].expand_as(reference)
+    diff = (out - reference)[valid]
+    em_ref = em_unscale(reference[valid].double())
+    em_out = em_unscale(out[valid].double())
+    total_ref = em_unscale(reference.double()).sum(dim=1)
+    total_out = em_unscale(out.double()).sum(dim=1)
+    total_valid = torch.from_numpy(status == 0)
+    relative_total = ((total_out - total_ref).abs() / total_ref.clamp(min=1e-30))[total_valid]
+    return {'max abs error (scaled)': diff.abs().max().item(),
+        'rms error (scaled)': diff.pow(2).mean().sqrt().item(),
+        'relative EM error (median)': ((em_out - em_ref).abs() / em_ref.clamp(min=1e20)).median().item(),
+        'relative total EM error (median)': relative_total.median().item()}
+
+if (__name__ == '__main__'):
+
+    parser = argparse.ArgumentParser(description='Export DeepEM for inference')
+    parser.add_argument('-m','--model', help='Trained model (state_dict)', default='DeepEM_CNN_HelioML.pth')
+    parser.add_argument('-o','--out', help='TorchScript artifact', default='DeepEM_CNN_HelioML.pt')
+    parser.add_argument('-q','--quantize', help='Also export the int8 dynamically quantized variant', action='store_true')
+    parser.add_argument('-p','--path', help='Directory with the DeepEM data', default='./DeepEM_Data/')
+    parser.add_argument('-r','--repeat', help='Repetitions of the throughput measurement', type=int, default=3)
+    parsed = vars(parser.parse_args())
+
+    model = deepem_model()
+    model.load_state_dict(torch.load(parsed['model'], map_location=lambda storage, loc: storage))
+    model.eval()
+
+    models = {'eager float32': model}
+    models['torchscript float32'] = export_model(model, parsed['out'])
+    print('Saved {0}'.format(parsed['out']))
+    if parsed['quantize']:
+        quantized = os.path.splitext(parsed['out'])[0] + '_int8.pt'
+        models['torchscript int8'] = export_model(model, quantized, quantize=True)
+        print('Saved {0}'.format(quantized))
+
+    X, status = get_samples(parsed['path'])
+    X = torch.from_numpy(X)
+
+    reference = None
+    for name, m in models.items():
+        out, speed = throughput(m, X, parsed['repeat'])
+        if reference is None:
+            reference, reference_speed = out, speed
+        print('{0}: {1:.3e} DEM solutions per second (x{2:.2f})'.format(name, speed, speed / reference_speed))
+        if m is not model:
+            for key, value in report(reference, out, status).items():
+                print('    {0}: {1:.3e}'.format(key, value))
+
+    # python export.py -m DeepEM_CNN_HelioML.pth -o DeepEM_CNN_HelioML.pt -q
@@ -0,0 +1,72 @@
+#Maps per second of the far-side UNet on the CPU, with the eager models of the
+#notebook and with the optimized path of deep_farside.optimize
+import os
+import time
+import argparse
+import torch
+import numpy as np
+
+from farside import UNet, deep_farside
+
+def get_models(checkpoints, hidden):
+    """
+    The trained checkpoints if given, otherwise UNets with random weights and
+    the given numbers of hidden channels, which is enough to measure timings
+    """
+    network = deep_farside(maxbatch=1)
+    if (checkpoints):
+        return [(c, n, network.load(c, n)) for c, n in zip(checkpoints, hidden)]
+    torch.manual_seed(0)
+    return [('random', n, UNet(n_channels=11, n_classes=1, n_hidden=n)) for n in hidden]
+
+def time_forward(network, phase, repeat):
+    network.forward(phase[0:network.max_batch])
+    start = time.time()
+    for r in range(repeat):
+        out = network.forward(phase)
+    return out, phase.shape[0] * repeat / (time.time() - start)
+
+def benchmark(models, shape, n_maps, batch, threads, repeat):
+    rng = np.random.RandomState(0)
+    phase = rng.randn(n_maps, 11, shape[0], shape[1]).astype('float32')
+
+    print('{0} maps of {1}x{2} pixels, batch of {3}, {4} threads'.format(n_maps, shape[0], shape[1], batch, threads))
+    print('{0:>12s} {1:>8s} {2:>14s} {3:>14s} {4:>14s} {5:>10s} {6:>12s}'.format('checkpoint', 'n_hidden', 'eager [maps/s]',
+        'chlast [maps/s]', 'jit [maps/s]', 'speedup', 'max error'))
+
+    for name, n_hidden, model in models:
+        speeds = []
+        outputs = []
+        for options in [None, {'jit': False}, {'jit': True}]:
+            torch.set_num_threads(threads)
+            network = deep_farside(maxbatch=batch)
+            network.model = model
+            if (options is not None):
+                network.optimize(threads=threads, **options)
+            out, speed = time_forward(network, phase, repeat)
+            speeds.append(speed)
+            outputs.append(out)
+        error = max(np.abs(out - outputs[0]).max() for out in outputs[1:])
+        print('{0:>12s} {1:8d} {2:14.2f} {3:14.2f} {4:14.2f} {5:10.2f} {6:12.3e}'.format(os.path.basename(name), n_hidden,
+            speeds[0], speeds[1], speeds[2], speeds[2] / speeds[0], error))
+
+if (__name__ == '__main__'):
+
+    parser = argparse.ArgumentParser(description='CPU benchmark of the far-side UNet')
+    parser.add_argument('-c','--checkpoint', help='Checkpoints, without the .pth extension', nargs='*', default=[])
+    parser.add_argument('--hidden', help='Hidden channels of each checkpoint (or of the random models)', type=int, nargs='+', default=[16])
+    parser.add_argument('-s','--shape', help='Size of the maps (latitude, longitude)', type=int, nargs=2, default=[144, 140])
+    parser.add_argument('-n','--maps', help='Number of maps per run', type=int, default=40)
+    parser.add_argument('-b','--batch', help='Maps per batch', type=int, default=20)
+    parser.add_argument('-t','--threads', help='Threads of torch', type=int, default=len(os.sched_getaffinity(0)))
+    parser.add_argument('-r','--repeat', help='Number of timed runs', type=int, default=3)
+    parsed = vars(parser.parse_args())
+
+    hidden = parsed['hidden']
+    if (parsed['checkpoint'] and len(hidden) == 1):
+        hidden = hidden * len(parsed['checkpoint'])
+
+    models = get_models(parsed['checkpoint'], hidden)
+    benchmark(models, parsed['shape'], parsed['maps'], parsed['batch'], parsed['threads'], parsed['repeat'])
+
+    # python benchmark.py -c 2019-04-02-11:27:48_hid_16_lr_0.0003_wd_0.0 --hidden 16 -b 20 -t 8
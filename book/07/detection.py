@@ -0,0 +1,85 @@
+#Detection of far-side active regions in a whole stack of probability maps, as
+#detect_sources and the sums of the integrated probability in the notebook but
+#with one filtering and one labeling pass over the (n_maps, nx, ny) stack
+import numpy as np
+from scipy import ndimage
+
+# Minimum integrated probability to claim an active region
+threshold_pi = 100.0
+
+def gaussian_kernel(fwhm=3.0, size=3):
+    """
+    Normalized Gaussian kernel, as Gaussian2DKernel(fwhm * gaussian_fwhm_to_sigma,
+    x_size=size, y_size=size) of astropy
+    """
+    sigma = fwhm / np.sqrt(8.0 * np.log(2.0))
+    x = np.arange(size) - (size - 1) / 2.0
+    kernel = np.exp(-(x[:,None]**2 + x[None,:]**2) / (2.0 * sigma**2))
+    return kernel / kernel.sum()
+
+def label_stack(prob, threshold=0.01, npixels=5, fwhm=3.0, size=3):
+    """
+    Segmentation of all the maps of the stack at once. Every map is smoothed
+    with the Gaussian kernel and the pixels above the threshold are grouped in
+    8-connected regions, which never extend across maps. Regions smaller than
+    npixels are discarded.
+
+    Returns the labels, (n_maps, nx, ny) with 0 for the background and labels
+    unique across the stack, and the number of labels.
+    """
+    prob = np.asarray(prob, dtype=np.float32)
+    kernel = gaussian_kernel(fwhm, size)[None,:,:].astype(np.float32)
+    smooth = ndimage.convolve(prob, kernel, mode='constant', cval=0.0)
+
+    # Connectivity only within each map
+    structure = np.zeros((3,3,3), dtype=bool)
+    structure[1] = True
+    labels, n_labels = ndimage.label(smooth > threshold, structure=structure)
+
+    area = np.bincount(labels.ravel(), minlength=n_labels+1)
+    keep = area >= npixels
+    keep[0] = False
+    relabel = np.zeros(n_labels+1, dtype=labels.dtype)
+    relabel[keep] = np.arange(1, keep.sum()+1)
+    return relabel[labels], int(keep.sum())
+
+def detect(prob, threshold=0.01, npixels=5, fwhm=3.0, size=3, min_pi=threshold_pi):
+    """
+    Catalog of the regions of a (n_maps, nx, ny) stack of probability maps.
+    The integrated probability P_i is the sum of the (unsmoothed) probability
+    over the pixels of the region, and the centroid is weighted by the
+    probability.
+
+    Returns a dictionary of columns, one row per region, and the labels:
+    map - Index of the map
+    label - Label of the region in the labels stack
+    x, y - Centroid in pixels along the two axes of the map
+    area - Number of pixels
+    pi - Integrated probability
+    detection - True if pi >= min_pi
+    """
+    prob = np.asarray(prob, dtype=np.float32)
+    labels, n_labels = label_stack(prob, threshold, npixels, fwhm, size)
+
+    # Only the pixels inside a region
+    inside = np.flatnonzero(labels)
+    flat = labels.ravel()[inside]
+    weights = prob.ravel()[inside].astype(np.float64)
+    index = np.unravel_index(inside, prob.shape)
+
+    area = np.bincount(flat, minlength=n_labels+1)[1:]
+    pi = np.bincount(flat, weights=weights, minlength=n_labels+1)[1:]
+    map_sum = np.bincount(flat, weights=index[0], minlength=n_labels+1)[1:]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x = np.bincount(flat, weights=weights*index[1], minlength=n_labels+1)[1:] / pi
+        y = np.bincount(flat, weights=weights*index[2], minlength=n_labels+1)[1:] / pi
+
+    catalog = {'map': np.rint(map_sum / np.maximum(area, 1)).astype(np.int64),
+        'label': np.arange(1, n_labels+1),
+        'x': x,
+        'y': y,
+        'area': area,
+        'pi': pi,
+        'detection': pi >= min_pi}
+
+    return catalog, labels
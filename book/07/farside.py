@@ -0,0 +1,606 @@
+#This module collects the far-side UNet and the deep_farside forward model of
+#the notebook so that they can be applied to long archives of seismic maps
+import numpy as np
+import os
+import time
+import resource
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import torch
+import torch.nn as nn
+import torch.utils.data
+import torch.nn.functional as F
+
+class double_conv(nn.Module):
+    '''(conv => BN => ReLU) * 2'''
+    def __init__(self, in_ch, out_ch):
+        super(double_conv, self).__init__()
+        self.conv = nn.Sequential(
+            nn.Conv2d(in_ch, out_ch, 3, padding=1),
+            nn.BatchNorm2d(out_ch),
+            nn.ReLU(inplace=True),
+            nn.Conv2d(out_ch, out_ch, 3, padding=1),
+            nn.BatchNorm2d(out_ch),
+            nn.ReLU(inplace=True)
+        )
+
+    def forward(self, x):
+        x = self.conv(x)
+        return x
+
+
+class inconv(nn.Module):
+    def __init__(self, in_ch, out_ch):
+        super(inconv, self).__init__()
+        self.conv = double_conv(in_ch, out_ch)
+
+    def forward(self, x):
+        x = self.conv(x)
+        return x
+
+
+class down(nn.Module):
+    def __init__(self, in_ch, out_ch):
+        super(down, self).__init__()
+        self.mpconv = nn.Sequential(
+            nn.MaxPool2d(2),
+            double_conv(in_ch, out_ch)
+        )
+
+    def forward(self, x):
+        x = self.mpconv(x)
+        return x
+
+
+class up(nn.Module):
+    def __init__(self, in_ch, out_ch, bilinear=True):
+        super(up, self).__init__()
+
+        self.bilinear = bilinear
+
+        #  would be a nice idea if the upsampling could be learned too,
+        if not bilinear:
+            self.up = nn.ConvTranspose2d(in_ch//2, in_ch//2, 2, stride=2)
+
+        self.conv = double_conv(in_ch, out_ch)
+
+    def forward(self, x1, x2):
+
+        if (self.bilinear):
+            x1 = torch.nn.functional.interpolate(x1, scale_factor=2)        
+        else:
+            x1 = self.up(x1)
+        
+        # input is CHW
+        diffY = x2.size()[2] - x1.size()[2]
+        diffX = x2.size()[3] - x1.size()[3]
+
+        x1 = F.pad(x1, (diffX // 2, diffX - diffX//2,
+                        diffY // 2, diffY - diffY//2))
+        
+        # for padding issues, see 
+        # https://github.com/HaiyongJiang/U-Net-Pytorch-Unstructured-Buggy/commit/0e854509c2cea854e247a9c615f175f76fbb2e3a
+        # https://github.com/xiaopeng-liao/Pytorch-UNet/commit/8ebac70e633bac59fc22bb5195e513d5832fb3bd
+
+        x = torch.cat([x2, x1], dim=1)
+        x = self.conv(x)
+        return x
+
+
+class outconv(nn.Module):
+    def __init__(self, in_ch, out_ch):
+        super(outconv, self).__init__()
+        self.conv = nn.Conv2d(in_ch, out_ch, 1)
+
+    def forward(self, x):
+        x = self.conv(x)
+        return x
+
+
+class UNet(nn.Module):
+    def __init__(self, n_channels, n_classes, n_hidden=64):
+        super(UNet, self).__init__()
+        self.inc = inconv(n_channels, n_hidden)
+        self.down1 = down(n_hidden, 2*n_hidden)
+        self.down2 = down(2*n_hidden, 4*n_hidden)
+        self.down3 = down(4*n_hidden, 8*n_hidden)
+        self.down4 = down(8*n_hidden, 8*n_hidden)
+        self.up1 = up(16*n_hidden, 4*n_hidden)
+        self.up2 = up(8*n_hidden, 2*n_hidden)
+        self.up3 = up(4*n_hidden, n_hidden)
+        self.up4 = up(2*n_hidden, n_hidden)
+        self.outc = outconv(n_hidden, n_classes)
+
+    def forward(self, x):
+        x1 = self.inc(x)
+        x2 = self.down1(x1)
+        x3 = self.down2(x2)
+        x4 = self.down3(x3)
+        x5 = self.down4(x4)
+        x = self.up1(x5, x4)
+        x = self.up2(x, x3)
+        x = self.up3(x, x2)
+        x = self.up4(x, x1)
+        x = self.outc(x)
+        return torch.sigmoid(x)
+
+
+def streaming_stats(phase, chunk, weights=None):
+    """
+    Mean and standard deviation of the whole array (NaNs counted as zero, as
+    np.nan_to_num in the notebook), in one pass over chunks of `chunk` maps
+    combined with the parallel form of Welford's algorithm. Only one chunk is
+    in memory at a time, so h5py.Dataset and memmaps can be used directly.
+    weights - Optional number of times each element of the first axis is
+    counted, e.g. the number of 11-map windows that contain each map of a series
+    """
+    count, mean, m2 = 0.0, 0.0, 0.0
+    for left in range(0, phase.shape[0], chunk):
+        block = np.nan_to_num(np.asarray(phase[left:left+chunk], dtype=np.float64))
+        block = block.reshape(block.shape[0], -1)
+        w = np.ones(block.shape[0]) if weights is None else np.asarray(weights[left:left+chunk], dtype=np.float64)
+        n = w * block.shape[1]
+        if (n.sum() == 0):
+            continue
+        # Statistics of each map combined into those of the chunk
+        map_mean = block.mean(axis=1)
+        block_mean = (n * map_mean).sum() / n.sum()
+        block_m2 = (w * ((block - map_mean[:,None])**2).sum(axis=1)).sum() + (n * (map_mean - block_mean)**2).sum()
+        delta = block_mean - mean
+        total = count + n.sum()
+        mean += delta * n.sum() / total
+        m2 += block_m2 + delta**2 * count * n.sum() / total
+        count = total
+    return mean, np.sqrt(m2 / count)
+
+def window_counts(n_days, n_phases=11):
+    """
+    Number of n_phases-map windows of a series of n_days maps that contain each map
+    """
+    k = np.arange(n_days)
+    return np.minimum(np.minimum(k + 1, n_days - k), min(n_phases, n_days - n_phases + 1))
+
+def windows(series, n_phases=11):
+    """
+    View of a (n_days, nx, ny) series as the (n_days-n_phases+1, n_phases, nx,
+    ny) cases of consecutive maps, without copying
+    """
+    return np.moveaxis(np.lib.stride_tricks.sliding_window_view(series, n_phases, axis=0), -1, 1)
+
+def current_rss():
+    """
+    Resident set size of the process in bytes
+    """
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+def peak_rss(function, interval=0.002):
+    """
+    Run function() and return its result and the peak resident set size in
+    bytes reached meanwhile, sampled by a background thread (and ru_maxrss,
+    in case the peak was missed between samples)
+    """
+    peak = [current_rss()]
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    done = threading.Event()
+
+    def sample():
+        while not done.is_set():
+            peak[0] = max(peak[0], current_rss())
+            time.sleep(interval)
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    try:
+        result = function()
+    finally:
+        done.set()
+        sampler.join()
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if (after > before):
+        peak[0] = max(peak[0], 1024 * after)
+    return result, peak[0]
+
+class deep_farside(object):
+    def __init__(self, maxbatch, rss_budget=None):
+        """
+        maxbatch - Maps per batch, or 'auto' to choose it with tune() the first
+        time forward is called
+        rss_budget - Memory budget of the process (resident set size) in MB for
+        the automatic batch size. If None, 80% of the available memory
+        """
+
+        self.cuda = torch.cuda.is_available()
+        self.device = torch.device("cuda" if self.cuda else "cpu")
+    
+        torch.backends.cudnn.benchmark = True
+        
+        self.max_batch = maxbatch
+        self.rss_budget = rss_budget
+        self.checkpoint = None
+        self.n_hidden = None
+        self.models = None
+        self.threads = 1
+        self.optimized = False
+        self.compiled = {}
+        self.metadata = {'max_batch': maxbatch, 'batch_mode': 'fixed'}
+                                
+    def load(self, checkpoint, n_hidden):
+        
+        model = UNet(n_channels=11, n_classes=1, n_hidden=n_hidden).to(self.device)
+                
+        if (self.cuda):
+            checkpoint = torch.load('{0}.pth'.format(checkpoint))
+        else:
+            checkpoint = torch.load('{0}.pth'.format(checkpoint), map_location=lambda storage, loc: storage)
+            
+        model.load_state_dict(checkpoint['state_dict'])
+        return model
+
+    def init_model(self, checkpoint=None, n_hidden=16):
+        
+        self.checkpoint = checkpoint
+        self.n_hidden = n_hidden
+        self.models = None
+        # Traced versions of the previous models, if optimized
+        self.compiled = {}
+
+        self.model = self.load(checkpoint, n_hidden)
+
+    def init_ensemble(self, checkpoints, n_hidden=16, threads=1):
+        """
+        Ensemble of several checkpoints applied to the same normalized batches
+        checkpoints - List of checkpoints, without the .pth extension
+        n_hidden - Hidden channels of every model, or a list with one value per model
+        threads - Models run concurrently on each batch by a pool of threads
+        (1 runs them one after the other on the same batch)
+
+        forward then returns the maps of every model and their mean and variance.
+        The automatic batch size is tuned with the largest model, for one
+        model running at a time.
+        """
+        if (np.isscalar(n_hidden)):
+            n_hidden = [n_hidden] * len(checkpoints)
+
+        self.checkpoint = list(checkpoints)
+        self.n_hidden = list(n_hidden)
+        self.threads = threads
+        self.compiled = {}
+        self.models = [self.load(c, n) for c, n in zip(checkpoints, n_hidden)]
+        self.model = self.models[int(np.argmax(n_hidden))]
+
+    def optimize(self, threads=None, channels_last=True, jit=True, warmup=2):
+        """
+        Optimized inference path for the CPU, used by forward afterwards
+        threads - Threads of the torch intra-op pool (all the cores available to
+        the process if None)
+        channels_last - Models and batches in the channels-last memory format
+        jit - Trace the models for the shape of the maps and freeze them, which
+        also folds the batch normalizations into the convolutions
+        warmup - Runs of every model on a batch of max_batch maps before the
+        first batch, so that the first timings are not spent in the profiling
+        and the allocation of the JIT
+
+        The models are traced and warmed up the first time forward sees a given
+        shape of the maps.
+        """
+        if (threads is None):
+            threads = len(os.sched_getaffinity(0))
+        torch.set_num_threads(threads)
+
+        self.optimized = True
+        self.channels_last = channels_last
+        self.jit = jit
+        self.warmup = warmup
+        self.compiled = {}
+        self.metadata.update({'threads': threads, 'channels_last': channels_last, 'jit': jit})
+
+    def runtime(self, shape):
+        """
+        Models used for cases of the given shape (11, nx, ny): the eager models
+        or, after optimize(), their traced versions for that shape
+        """
+        models = self.models if self.models is not None else [self.model]
+        if (not self.optimized):
+            return models
+
+        if (shape not in self.compiled):
+            batch = self.max_batch if self.max_batch != 'auto' else 1
+            example = torch.zeros((batch,) + tuple(shape), dtype=torch.float32).to(self.device)
+            if (self.channels_last):
+                example = example.contiguous(memory_format=torch.channels_last)
+
+            compiled = []
+            with torch.no_grad():
+                for model in models:
+                    model.eval()
+                    if (self.channels_last):
+                        model = model.to(memory_format=torch.channels_last)
+                    if (self.jit):
+                        model = torch.jit.freeze(torch.jit.trace(model, example))
+                    for i in range(self.warmup):
+                        model(example)
+                    compiled.append(model)
+            self.compiled[shape] = compiled
+
+        return self.compiled[shape]
+
+    def predict(self, model, phases):
+        """
+        Probability maps of one model for a batch already on the device
+        """
+        if (self.optimized and self.channels_last):
+            phases = phases.contiguous(memory_format=torch.channels_last)
+        with torch.no_grad():
+            return model(phases)[:,0,:,:].cpu().numpy()
+
+    def normalize(self, phase, mean, std, out):
+        """
+        Normalization of the notebook applied to one batch, written into the
+        float32 buffer `out` (its first len(phase) maps)
+        """
+        out = out[0:phase.shape[0]]
+        out[:] = phase
+        np.nan_to_num(out, copy=False)
+        out -= mean
+        out /= std
+        out[out>0] = 0.0
+        return out
+
+    def buffers(self, shape):
+        """
+        Two float32 input buffers of max_batch maps, pinned in host memory when
+        running on the GPU, and their numpy views
+        """
+        pinned = []
+        for i in range(2):
+            buffer = torch.empty((self.max_batch,) + shape, dtype=torch.float32, pin_memory=self.cuda)
+            pinned.append((buffer, buffer.numpy()))
+        return pinned
+        
+    def tune(self, shape, n_cases, rss_budget=None, candidates=None, repeat=2, margin=1.1, writer=None, n_models=None):
+        """
+        Choose max_batch from the memory use and throughput of the UNet for
+        batches of increasing size (1, 2, 4, ... up to 256 maps by default)
+        shape - Shape of one case (11, nx, ny)
+        n_cases - Number of cases to predict, for the memory of the output
+        writer - Writer used by forward, if any. The output is then never held
+        in memory, only the maps of one batch
+        n_models - Number of models of an ensemble (None for a single model),
+        whose maps are kept with their mean and variance
+        rss_budget - Memory budget of the process in MB (self.rss_budget or 80%
+        of the available memory if None)
+
+        The memory of a batch is extrapolated linearly from the smaller ones
+        before it is tried, so sizes that would exceed the budget are never
+        run. The fastest batch size within the budget is selected and recorded
+        in self.metadata. Only the host memory is taken into account.
+        """
+        if (rss_budget is None):
+            rss_budget = self.rss_budget
+        if (rss_budget is None):
+            with open('/proc/meminfo') as f:
+                meminfo = dict(line.split(':') for line in f)
+            rss_budget = 0.8 * int(meminfo['MemAvailable'].split()[0]) / 1024.0 + current_rss() / 1024.0**2
+        budget = rss_budget * 1024.0**2
+
+        if (candidates is None):
+            candidates = [2**i for i in range(9)]
+        candidates = sorted(c for c in candidates if c <= max(n_cases, 1)) or [1]
+
+        map_bytes = 4 * int(np.prod(shape))
+        # Output maps per case: one per model plus the mean and variance of an ensemble
+        out_maps = 1 if n_models is None else n_models + 2
+        out_bytes = 4 * out_maps * shape[1] * shape[2]
+        # Neither the output nor the second prefetch buffer are allocated by the probes
+        if (writer is None):
+            reserve, batch_bytes = n_cases * out_bytes, map_bytes
+        else:
+            reserve, batch_bytes = 0, map_bytes + out_bytes
+
+        print("Tuning batch size for a budget of {0:.0f} MB...".format(rss_budget))
+
+        self.model.eval()
+        # Memory with an empty batch, the starting point of the extrapolation
+        measured = [(0, current_rss() + reserve)]
+        best = None
+
+        with torch.no_grad():
+            for batch in candidates:
+                (b0, m0), (b1, m1) = measured[-2:] if len(measured) > 1 else (measured[0], measured[0])
+                predicted = m1 + (m1 - m0) / (b1 - b0) * (batch - b1) if b1 > b0 else m1
+                if (margin * predicted > budget):
+                    break
+
+                x = torch.zeros((batch,) + tuple(shape), dtype=torch.float32).to(self.device)
+                self.model(x)
+                peak = 0
+                start = time.time()
+                for i in range(repeat):
+                    peak = max(peak, peak_rss(lambda: self.model(x).cpu())[1])
+                elapsed = (time.time() - start) / repeat
+                del x
+
+                peak += reserve + batch * batch_bytes
+                if (peak > budget):
+                    break
+
+                measured.append((batch, peak))
+                speed = batch / elapsed
+                print(" - Batch {0:4d} : {1:8.1f} MB, {2:8.2f} maps/s".format(batch, peak / 1024.0**2, speed))
+                if (best is None or speed > best[1]):
+                    best = (batch, speed, peak)
+
+        if (best is None):
+            raise MemoryError("A batch of one map does not fit in {0:.0f} MB".format(rss_budget))
+
+        self.max_batch = best[0]
+        self.metadata.update({'max_batch': best[0], 'batch_mode': 'auto', 'rss_budget_mb': rss_budget,
+            'tuned_rss_mb': best[2] / 1024.0**2, 'tuned_maps_per_second': best[1]})
+
+        print(" - Selected max_batch : {0}".format(self.max_batch))
+        return self.max_batch
+
+    def forward(self, phase, writer=None):
+        """
+        Probability maps of a (n_cases, 11, nx, ny) array of seismic maps. The
+        array can be an h5py.Dataset or a memmap (e.g. f['phases'] instead of
+        f['phases'][:]): it is read once to compute its mean and standard
+        deviation and then batch by batch, so that memory scales with
+        max_batch and not with the length of the archive. The input is not
+        modified.
+
+        Batch i+1 is read and normalized by a background thread while the
+        network runs on batch i, alternating between two preallocated
+        buffers. Returns float32 maps. The batch size used is recorded in
+        self.metadata.
+
+        phase can also be a continuous (n_days, nx, ny) series of maps. The
+        cases are then its n_days-10 windows of 11 consecutive maps, built
+        batch by batch from max_batch+10 maps read and normalized once, so
+        the series does not have to be expanded 11 times. The normalization
+        is the same as for the expanded array.
+
+        writer - Optional h5writer.probability_writer. Each batch is then
+        appended to its HDF5 dataset instead of being kept in memory, with the
+        checkpoint, the normalization statistics and self.metadata as
+        attributes. If the writer resumes a partly written file, the maps
+        already written are skipped. The writer is closed at the end and
+        returned instead of the maps.
+
+        With an ensemble (init_ensemble), every batch is normalized once and
+        run through all the models. The maps of each model, (n_models,
+        n_cases, nx, ny), and their mean and variance are returned, or written
+        to the datasets <name>_<k>, <name>_mean and <name>_variance.
+        """
+
+        series = (len(phase.shape) == 3)
+
+        if (series):
+            n_days, nx, ny = phase.shape
+            n_phases = 11
+            n_cases = n_days - n_phases + 1
+            assert (n_cases > 0), "less than 11 maps in the series"
+        else:
+            n_cases, n_phases, nx, ny = phase.shape
+
+        assert (n_phases == 11), "n. phases is not 11"
+
+        if (self.max_batch == 'auto'):
+            self.tune((n_phases, nx, ny), n_cases, writer=writer, n_models=len(self.models) if self.models is not None else None)
+
+        print("Normalizing data...")
+
+        if (series):
+            mean, std = streaming_stats(phase, self.max_batch, weights=window_counts(n_days, n_phases))
+        else:
+            mean, std = streaming_stats(phase, self.max_batch)
+
+        ensemble = self.models is not None
+        for model in (self.models if ensemble else [self.model]):
+            model.eval()
+        models = self.runtime((n_phases, nx, ny))
+
+        start = 0
+        if (writer is None):
+            magnetograms = np.empty((len(models),n_cases,nx,ny), dtype=np.float32)
+        else:
+            attrs = dict(self.metadata)
+            attrs.update({'checkpoint': self.checkpoint, 'n_hidden': self.n_hidden, 'mean': mean, 'std': std,
+                'n_cases': n_cases, 'input': 'series' if series else 'cases'})
+            start = writer.open(n_cases, nx, ny, attrs, n_models=len(models) if ensemble else None)
+
+        batches = list(range(start, n_cases, self.max_batch))
+
+        print(" - Total number of maps : {0}".format(n_cases))
+        print(" - Total number of batches : {0}".format(len(batches)))
+
+        buffers = self.buffers((n_phases, nx, ny))
+        if (series):
+            slabs = [np.empty((self.max_batch+n_phases-1, nx, ny), dtype=np.float32) for i in range(2)]
+
+        def prepare(i):
+            left = batches[i]
+            tensor, array = buffers[i % 2]
+            if (series):
+                slab = self.normalize(phase[left:left+self.max_batch+n_phases-1], mean, std, slabs[i % 2])
+                cases = windows(slab, n_phases)
+                n = cases.shape[0]
+                array[0:n] = cases
+            else:
+                n = self.normalize(phase[left:left+self.max_batch], mean, std, array).shape[0]
+            return tensor[0:n]
+
+        print("Predicting magnetograms...")
+
+        pool = ThreadPoolExecutor(max_workers=self.threads) if (ensemble and self.threads > 1) else None
+
+        try:
+            with torch.no_grad(), ThreadPoolExecutor(max_workers=1) as reader:
+
+                if (len(batches) > 0):
+                    future = reader.submit(prepare, 0)
+
+                for i, left in enumerate(batches):
+                    phases = future.result()
+                    # The other buffer is free once the output of batch i-1 is on the host
+                    if (i + 1 < len(batches)):
+                        future = reader.submit(prepare, i + 1)
+
+                    phases = phases.to(self.device, non_blocking=True)
+                    if (pool is None):
+                        output = np.stack([self.predict(model, phases) for model in models])
+                    else:
+                        output = np.stack(list(pool.map(lambda model: self.predict(model, phases), models)))
+
+                    if (writer is None):
+                        magnetograms[:,left:left+phases.shape[0],:,:] = output
+                    elif (ensemble):
+                        writer.write(left, output, output.mean(axis=0), output.var(axis=0))
+                    else:
+                        writer.write(left, output[0])
+        finally:
+            if (pool is not None):
+                pool.shutdown()
+            if (writer is not None):
+                writer.close()
+
+        if (writer is not None):
+            return writer
+        if (ensemble):
+            return magnetograms, magnetograms.mean(axis=0), magnetograms.var(axis=0)
+        return magnetograms[0]
+
+if (__name__ == '__main__'):
+
+    import argparse
+    import h5py
+    from h5writer import dtypes, probability_writer
+
+    parser = argparse.ArgumentParser(description='Far-side active region probability maps')
+    parser.add_argument('-i','--input', help='HDF5 file with the seismic maps', required=True)
+    parser.add_argument('-d','--dataset', help='Dataset of the maps, (n_cases, 11, nx, ny) or a (n_days, nx, ny) series', default='phases')
+    parser.add_argument('-c','--checkpoint', help='Checkpoint, without the .pth extension. Several for an ensemble', nargs='+', required=True)
+    parser.add_argument('-o','--output', help='Output HDF5 file', required=True)
+    parser.add_argument('-b','--batch', help='Maps per batch, or auto', default='auto')
+    parser.add_argument('-m','--memory', help='Memory budget in MB for the automatic batch size', type=float, default=None)
+    parser.add_argument('-t','--dtype', help='Type of the output', choices=dtypes, default='float32')
+    parser.add_argument('-r','--resume', help='Resume a partly written output', action='store_true')
+    parser.add_argument('--hidden', help='Hidden channels of the UNet, one value or one per checkpoint', type=int, nargs='+', default=[16])
+    parser.add_argument('--threads', help='Models of the ensemble run concurrently', type=int, default=1)
+    parsed = vars(parser.parse_args())
+
+    maxbatch = parsed['batch'] if parsed['batch'] == 'auto' else int(parsed['batch'])
+    network = deep_farside(maxbatch=maxbatch, rss_budget=parsed['memory'])
+    if (len(parsed['checkpoint']) == 1):
+        network.init_model(checkpoint=parsed['checkpoint'][0], n_hidden=parsed['hidden'][0])
+    else:
+        hidden = parsed['hidden'] if len(parsed['hidden']) > 1 else parsed['hidden'][0]
+        network.init_ensemble(parsed['checkpoint'], n_hidden=hidden, threads=parsed['threads'])
+
+    with h5py.File(parsed['input'], 'r') as f:
+        network.forward(f[parsed['dataset']], writer=probability_writer(parsed['output'], dtype=parsed['dtype'], resume=parsed['resume']))
+
+    # python farside.py -i test.h5 -c 2019-04-02-11:27:48_hid_16_lr_0.0003_wd_0.0 -o probability.h5 -b auto -m 8000
+
+    # python farside.py -i test.h5 -c model_a model_b model_c --hidden 16 32 16 -o ensemble.h5 -b 20
@@ -0,0 +1,124 @@
+#Output of deep_farside.forward to a chunked and compressed HDF5 dataset, written
+#batch by batch as the maps are produced, so that long archives can be
+#reprocessed without keeping all the probability maps in memory and resumed
+#if the run is interrupted
+import os
+import time
+import h5py
+import numpy as np
+
+dtypes = ['float32', 'float16']
+
+class probability_writer(object):
+    def __init__(self, filename, dataset='probability', dtype='float32', compression='gzip', level=4, resume=False):
+        """
+        filename - Output HDF5 file
+        dataset - Name of the dataset of the probability maps
+        dtype - 'float32' or 'float16'
+        compression, level - HDF5 filter and its level (None for no compression)
+        resume - Continue a partly written file instead of overwriting it
+        """
+        if (dtype not in dtypes):
+            raise ValueError("dtype must be one of {0}".format(dtypes))
+
+        self.filename = filename
+        self.dataset = dataset
+        self.dtype = dtype
+        self.compression = compression
+        self.level = level if compression == 'gzip' else None
+        self.resume = resume and os.path.exists(filename)
+        self.handle = None
+        self.n_written = 0
+        self.names = [dataset]
+
+    def check(self, ds, n_cases, nx, ny, attrs):
+        """
+        Check that the file being resumed was written for the same input and model
+        """
+        if (ds.shape != (n_cases, nx, ny) or ds.dtype != np.dtype(self.dtype)):
+            raise ValueError("{0} has shape {1} and dtype {2}, expected {3} and {4}".format(self.filename,
+                ds.shape, ds.dtype, (n_cases, nx, ny), self.dtype))
+        for key in ['checkpoint', 'mean', 'std', 'n_cases']:
+            if (key not in attrs or key not in ds.attrs):
+                continue
+            if (isinstance(attrs[key], float)):
+                # The statistics depend on the chunks in the last digits
+                same = np.isclose(ds.attrs[key], attrs[key], rtol=1e-10, atol=0.0)
+            else:
+                same = np.array_equal(np.asarray(ds.attrs[key]).astype(str), np.asarray(attrs[key]).astype(str))
+            if (not same):
+                raise ValueError("{0} was written with {1}={2}, not {3}".format(self.filename, key, ds.attrs[key], attrs[key]))
+
+    def open(self, n_cases, nx, ny, attrs, n_models=None):
+        """
+        Create the (n_cases, nx, ny) dataset, chunked per map, or reopen it if
+        resuming. attrs are the provenance attributes (checkpoint, normalization
+        statistics, batch size...). When resuming, those that identify the
+        input and the model have to be equal to the stored ones.
+        n_models - For an ensemble, the datasets <dataset>_<k> of each model
+        and <dataset>_mean and <dataset>_variance are created instead
+
+        Returns the number of maps already written.
+        """
+        attrs = {key: 'none' if value is None else value for key, value in attrs.items()}
+
+        if (n_models is not None):
+            self.names = ['{0}_{1}'.format(self.dataset, k) for k in range(n_models)]
+            self.names += ['{0}_mean'.format(self.dataset), '{0}_variance'.format(self.dataset)]
+
+        if (self.resume):
+            self.handle = h5py.File(self.filename, 'a')
+            try:
+                for name in self.names:
+                    if (name not in self.handle):
+                        raise ValueError("{0} has no dataset {1}".format(self.filename, name))
+                    self.check(self.handle[name], n_cases, nx, ny, attrs)
+            except ValueError:
+                self.handle.close()
+                self.handle = None
+                raise
+            self.n_written = min(int(self.handle[name].attrs['n_written']) for name in self.names)
+            print("Resuming {0} after {1} maps".format(self.filename, self.n_written))
+        else:
+            self.handle = h5py.File(self.filename, 'w')
+            for name in self.names:
+                ds = self.handle.create_dataset(name, shape=(n_cases, nx, ny), dtype=self.dtype,
+                    chunks=(1, nx, ny), compression=self.compression, compression_opts=self.level,
+                    shuffle=self.compression is not None)
+                ds.attrs['created'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+            self.n_written = 0
+
+        for name in self.names:
+            ds = self.handle[name]
+            for key, value in attrs.items():
+                ds.attrs[key] = value
+            ds.attrs['n_written'] = self.n_written
+        self.handle.flush()
+        return self.n_written
+
+    def write(self, left, data, mean=None, variance=None):
+        """
+        Write the maps of one batch, starting at map `left`. Batches have to be
+        written in order, the progress is stored after each one.
+        data - (n, nx, ny) maps, or (n_models, n, nx, ny) for an ensemble, with
+        their mean and variance
+        """
+        if (len(self.names) == 1):
+            data = data[None,:,:,:]
+        else:
+            data = np.concatenate([data, mean[None,:,:,:], variance[None,:,:,:]])
+        n = data.shape[1]
+        for name, maps in zip(self.names, data):
+            self.handle[name][left:left+n] = maps.astype(self.dtype)
+        self.n_written = left + n
+        for name in self.names:
+            self.handle[name].attrs['n_written'] = self.n_written
+        self.handle.flush()
+
+    def close(self):
+        if (self.handle is not None):
+            for name in self.names:
+                ds = self.handle[name]
+                ds.attrs['complete'] = self.n_written == ds.shape[0]
+            self.handle.close()
+            self.handle = None
@@ -0,0 +1,176 @@
+#Temporal consistency of the far-side detections: a detection is only claimed as
+#an active region if it appears again at the same Carrington position in the
+#following maps. The tracker ingests the catalogs of detection.detect map by map
+#and only keeps the tracks that are still active
+import numpy as np
+
+# Synodic rotation rate of the Carrington frame as seen from Earth [deg/day]
+carrington_rate = 360.0 / 27.2753
+
+def central_carrington(time, carrington0, time0=0.0):
+    """
+    Carrington longitude of the center of a map at `time` (days), given its
+    value carrington0 at time0. The longitude decreases with time.
+    """
+    return np.mod(carrington0 - carrington_rate * (np.asarray(time) - time0), 360.0)
+
+def angular_distance(lon1, lat1, lon2, lat2):
+    """
+    Great-circle distance in degrees (haversine)
+    """
+    lon1, lat1, lon2, lat2 = map(np.radians, (lon1, lat1, lon2, lat2))
+    a = np.sin(0.5*(lat2-lat1))**2 + np.cos(lat1)*np.cos(lat2)*np.sin(0.5*(lon2-lon1))**2
+    return np.degrees(2.0 * np.arcsin(np.sqrt(np.minimum(a, 1.0))))
+
+class farside_tracker(object):
+    def __init__(self, radius=10.0, min_hits=3, max_gap=1.0, lat0=-72.0, dlat=1.0, dlon=1.0, n_lon_pixels=140):
+        """
+        radius - Maximum distance in degrees between a detection and the last
+        position of a track to continue it
+        min_hits - Number of maps in which a track has to be detected to be confirmed
+        max_gap - Time in days without detections after which a track expires
+        lat0, dlat, dlon - Latitude of the first row and resolution of the maps
+        n_lon_pixels - Number of columns of the maps. The longitude is measured
+        from the central column of each map
+
+        Differential rotation is not corrected, it is absorbed by the radius.
+        """
+        self.radius = radius
+        self.min_hits = min_hits
+        self.max_gap = max_gap
+        self.lat0 = lat0
+        self.dlat = dlat
+        self.dlon = dlon
+        self.center = 0.5 * (n_lon_pixels - 1)
+
+        # Grid of cells of size radius in longitude and latitude -> ids of the tracks
+        self.n_lon = max(int(360.0 // radius), 1)
+        self.cells = {}
+        self.tracks = {}
+        self.next_id = 0
+
+    def cell(self, lon, lat):
+        return (int(lon // self.radius) % self.n_lon, int(np.floor(lat / self.radius)))
+
+    def add(self, track):
+        self.tracks[track['id']] = track
+        self.cells.setdefault(track['cell'], set()).add(track['id'])
+
+    def remove(self, track):
+        cell = self.cells[track['cell']]
+        cell.discard(track['id'])
+        if (len(cell) == 0):
+            del self.cells[track['cell']]
+        del self.tracks[track['id']]
+
+    def move(self, track, lon, lat):
+        self.cells[track['cell']].discard(track['id'])
+        if (len(self.cells[track['cell']]) == 0):
+            del self.cells[track['cell']]
+        track['lon'], track['lat'] = lon, lat
+        track['cell'] = self.cell(lon, lat)
+        self.cells.setdefault(track['cell'], set()).add(track['id'])
+
+    def neighbours(self, lon, lat):
+        """
+        Ids of the tracks in the cells that can contain tracks closer than the
+        radius. Cells wrap in longitude and are searched further in longitude
+        at high latitudes, where a degree of longitude is shorter.
+        """
+        i, j = self.cell(lon, lat)
+        coslat = np.cos(np.radians(min(abs(lat) + self.radius, 89.0)))
+        k = min(int(np.ceil(1.0 / coslat)), self.n_lon // 2)
+        ids = []
+        for di in set((i + d) % self.n_lon for d in range(-k, k+1)):
+            for dj in (j-1, j, j+1):
+                ids.extend(self.cells.get((di, dj), ()))
+        return ids
+
+    def positions(self, catalog, carrington):
+        """
+        Carrington longitude and latitude of the centroids of the catalog of a
+        map centered at Carrington longitude `carrington`
+        """
+        lat = self.lat0 + self.dlat * np.asarray(catalog['x'])
+        lon = np.mod(carrington + self.dlon * (np.asarray(catalog['y']) - self.center), 360.0)
+        return lon, lat
+
+    def update(self, catalog, time, carrington, index=None, detections_only=True):
+        """
+        Ingest the detections of one map.
+        catalog - Catalog of detection.detect
+        time - Time of the map in days
+        carrington - Carrington longitude of the center of the map
+        index - Index of the map in the catalog, None if the catalog contains only one map
+        detections_only - Use only the regions above the P_i threshold
+
+        Returns the track id of each row of the catalog used (-1 for the rows
+        not used), and the tracks that expired, confirmed or not.
+        """
+        rows = np.ones(len(catalog['pi']), dtype=bool)
+        if (index is not None):
+            rows &= np.asarray(catalog['map']) == index
+        if (detections_only):
+            rows &= np.asarray(catalog['detection'])
+        rows = np.flatnonzero(rows)
+
+        lon, lat = self.positions({'x': catalog['x'][rows], 'y': catalog['y'][rows]}, carrington)
+        pi = np.asarray(catalog['pi'])[rows]
+
+        # Candidate pairs within the radius, assigned greedily by distance
+        pairs = []
+        for n in range(len(rows)):
+            ids = self.neighbours(lon[n], lat[n])
+            if (len(ids) == 0):
+                continue
+            d = angular_distance(lon[n], lat[n], [self.tracks[t]['lon'] for t in ids], [self.tracks[t]['lat'] for t in ids])
+            pairs.extend((d[k], n, ids[k]) for k in np.flatnonzero(d <= self.radius))
+        pairs.sort()
+
+        assigned = -np.ones(len(catalog['pi']), dtype=np.int64)
+        used_rows, used_tracks = set(), set()
+        for d, n, t in pairs:
+            if (n in used_rows or t in used_tracks):
+                continue
+            used_rows.add(n)
+            used_tracks.add(t)
+            track = self.tracks[t]
+            self.move(track, lon[n], lat[n])
+            track['last'] = time
+            track['hits'] += 1
+            track['history'].append((time, lon[n], lat[n], pi[n]))
+            track['pi_max'] = max(track['pi_max'], pi[n])
+            if (track['hits'] >= self.min_hits):
+                track['confirmed'] = True
+            assigned[rows[n]] = t
+
+        for n in range(len(rows)):
+            if (n in used_rows):
+                continue
+            track = {'id': self.next_id, 'first': time, 'last': time, 'lon': lon[n], 'lat': lat[n],
+                'cell': self.cell(lon[n], lat[n]), 'hits': 1, 'pi_max': pi[n],
+                'history': [(time, lon[n], lat[n], pi[n])], 'confirmed': self.min_hits <= 1}
+            self.add(track)
+            assigned[rows[n]] = track['id']
+            self.next_id += 1
+
+        expired = [track for track in self.tracks.values() if time - track['last'] > self.max_gap]
+        for track in expired:
+            self.remove(track)
+
+        return assigned, expired
+
+    def flush(self):
+        """
+        Expire all the active tracks, at the end of the series
+        """
+        expired = list(self.tracks.values())
+        self.tracks = {}
+        self.cells = {}
+        return expired
+
+    def confirmed(self):
+        """
+        Active tracks that are already confirmed
+        """
+        return [track for track in self.tracks.values() if track['confirmed']]
@@ -0,0 +1,71 @@
+#Vectorized construction of the SEQ_LEN training sequences of the notebook. Each
+#SITL window is cut into (n_seq, SEQ_LEN, n_features) blocks with one reshape,
+#and the random train/test split of the windows is applied with index arrays,
+#so the retries of the split do not rebuild the sequences
+import random
+import numpy as np
+
+SEQ_LEN = 250
+
+def window_blocks(windows, seq_len=SEQ_LEN):
+    """
+    All the complete sequences of all the windows, in order, and the index of
+    the window of each sequence. The rows left at the end of each window are
+    dropped, as in the notebook.
+    windows - List of DataFrames (or arrays) whose last column is the label
+    Returns sequences of shape (n_sequences, seq_len, n_columns) and the window indices
+    """
+    blocks, owner = [], []
+    for i, window in enumerate(windows):
+        values = np.asarray(getattr(window, 'values', window))
+        n_seq = values.shape[0] // seq_len
+        blocks.append(values[0:n_seq*seq_len].reshape(n_seq, seq_len, values.shape[1]))
+        owner.append(np.full(n_seq, i))
+    if len(blocks) == 0:
+        return np.empty((0, seq_len, 0)), np.empty(0, dtype=int)
+    return np.concatenate(blocks), np.concatenate(owner)
+
+def labels(sequences, index):
+    """
+    Labels of the sequences, (n, seq_len, 1), with the dtype np.array gives to
+    the lists of labels of the notebook. Windows of mms_data.join(selections)
+    have float and bool columns, so their .values are object arrays and the
+    labels are bool (the features, rows of those arrays, stay object).
+    """
+    y = sequences[index, :, -1]
+    if y.dtype == object and y.size > 0:
+        y = np.array(y.tolist())
+    return y[:, :, None]
+
+def split_windows(n_windows, train_fraction=0.6, rng=random):
+    """
+    Random assignment of the windows to the training set, with one draw of
+    rng.random() per window in order, as the loop of the notebook
+    """
+    return np.array([rng.random() < train_fraction for i in range(n_windows)], dtype=bool)
+
+def build_sequences(windows, seq_len=SEQ_LEN, train_fraction=0.6, rng=random):
+    """
+    X_train, X_test, y_train, y_test of the notebook. The windows are split at
+    random until there are more training than test sequences. For the same
+    state of rng the result is identical to the loop of the notebook.
+    y_* have shape (n, seq_len, 1)
+    """
+    sequences, owner = window_blocks(windows, seq_len)
+    if len(owner) == 0:
+        # The split below would never find more training than test sequences
+        raise ValueError('No window has {0} rows'.format(seq_len))
+
+    while True:
+        train = split_windows(len(windows), train_fraction, rng)[owner]
+        train_index = np.flatnonzero(train)
+        test_index = np.flatnonzero(~train)
+        if len(train_index) > len(test_index):
+            break
+
+    X_train = sequences[train_index, :, :-1]
+    X_test = sequences[test_index, :, :-1]
+    y_train = labels(sequences, train_index)
+    y_test = labels(sequences, test_index)
+
+    return X_train, X_test, y_train, y_test